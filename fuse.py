@@ -356,9 +356,9 @@ class FUSE(object):
         ret = self.operations('read', path, size, offset, fh)
         if not ret:
             return 0
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
-        return size
+        ret = ret[:size]
+        memmove(buf, ret, len(ret))
+        return len(ret)
     
     def write(self, path, buf, size, offset, fip):
         data = string_at(buf, size)
@@ -421,15 +421,20 @@ class FUSE(object):
         # Ignore raw_fi
         for item in self.operations('readdir', path, fip.contents.fh):
             if isinstance(item, str):
-                name, st, offset = item, None, 0
+                name, st, itemOffset = item, None, 0
             else:
-                name, attrs, offset = item
-                if attrs:
+                name, attrs, itemOffset = item
+                if itemOffset and itemOffset <= offset:
+                    # Returned by an earlier call for this listing
+                    continue
+                if isinstance(attrs, c_stat):
+                    st = attrs
+                elif attrs:
                     st = c_stat()
                     set_st_attrs(st, attrs)
                 else:
                     st = None
-            if filler(buf, name, st, offset) != 0:
+            if filler(buf, name, st, itemOffset) != 0:
                 break
         return 0
     
@@ -463,10 +468,14 @@ class FUSE(object):
         return self.operations('truncate', path, length, fh)
     
     def fgetattr(self, path, buf, fip):
-        memset(buf, 0, sizeof(c_stat))
-        st = buf.contents
         fh = fip and (fip.contents if self.raw_fi else fip.contents.fh)
         attrs = self.operations('getattr', path, fh)
+        if isinstance(attrs, c_stat):
+            # Already filled in; copy it as is
+            memmove(buf, byref(attrs), sizeof(c_stat))
+            return 0
+        memset(buf, 0, sizeof(c_stat))
+        st = buf.contents
         set_st_attrs(st, attrs)
         return 0
     
@@ -533,7 +542,7 @@ class Operations(object):
     
     def getattr(self, path, fh=None):
         """Returns a dictionary with keys identical to the stat C structure
-           of stat(2).
+           of stat(2), or a c_stat that is copied as is.
            st_atime, st_mtime and st_ctime should be floats.
            NOTE: There is an incombatibility between Linux and Mac OS X concerning
            st_nlink of directories. Mac OS X counts all files inside the directory,
@@ -18,27 +18,227 @@
 
 from errno import ENOENT
 from stat import S_IFDIR, S_IFREG
-from time import time
-import os, sys
-from errno import EROFS, EACCES
-
-from fuse import FUSE, Operations, LoggingMixIn, fuse_get_context
-
-import LabJackPython, u3, u6, ue9, skymote
+from time import time, sleep
+from array import array
+from collections import deque, OrderedDict
+import os, sys, socket
+import json, struct, pickle
+import threading, Queue
+from optparse import OptionParser
+from ConfigParser import SafeConfigParser
+from errno import EROFS, EACCES, EEXIST, EIO, EINVAL
+
+from fuse import FUSE, Operations, LoggingMixIn, c_stat, set_st_attrs
+
+# The u3, u6 and ue9 drivers are imported where they're used, so only
+# those for device types actually found are ever loaded
+import LabJackPython
 
 DEBUG = False
 
 LJSOCKET_ADDRESS = "localhost"
 LJSOCKET_PORT = "6000"
 
+# LJSocket connections per device. Independent register reads are spread
+# over them, so up to this many are in flight at once.
+LJSOCKET_SETTINGS = {"connections" : 1}
+
 DEFAULT_MOUNT_POINT = "root-ljfuse"
 
-MODBUS_ADDRS = {"0":0444, "2":0444, "4":0444, "6":0444,
-                "5000":0664, "5002":0664, 
-                "6000":0664, "6001":0664, "6002":0664, "6003":0664, 
-                "6004":0664, "6005":0664, "6006":0664, "6007":0664,
-                "6100":0664, "6101":0664, "6102":0664, "6103":0664, 
-                "6104":0664, "6105":0664, "6106":0664, "6107":0664}
+# Modbus registers of each devType, as rows of (first address, count,
+# struct format, width, mode, name, first number). A row is count
+# registers of the same kind, each width 16-bit registers wide, starting
+# at first address. Their names are name % n, numbered from first number.
+REGISTER_MAP = {3 : [(0, 16, 'f', 2, 0444, "AIN%d", 0),
+                     (60, 2, 'f', 2, 0444, "AIN%d", 30),
+                     (5000, 2, 'f', 2, 0664, "DAC%d", 0),
+                     (6000, 20, 'H', 1, 0664, "IO%d state", 0),
+                     (6100, 20, 'H', 1, 0664, "IO%d direction", 0),
+                     (7000, 2, 'I', 2, 0664, "Timer%d", 0),
+                     (7200, 2, 'I', 2, 0664, "Counter%d", 0)],
+                6 : [(0, 144, 'f', 2, 0444, "AIN%d", 0),
+                     (5000, 2, 'f', 2, 0664, "DAC%d", 0),
+                     (6000, 23, 'H', 1, 0664, "IO%d state", 0),
+                     (6100, 23, 'H', 1, 0664, "IO%d direction", 0),
+                     (7000, 4, 'I', 2, 0664, "Timer%d", 0),
+                     (7200, 2, 'I', 2, 0664, "Counter%d", 0)],
+                9 : [(0, 14, 'f', 2, 0444, "AIN%d", 0),
+                     (256, 16, 'f', 2, 0444, "AIN%d", 128),
+                     (5000, 2, 'f', 2, 0664, "DAC%d", 0),
+                     (6000, 23, 'H', 1, 0664, "IO%d state", 0),
+                     (6100, 23, 'H', 1, 0664, "IO%d direction", 0),
+                     (7000, 6, 'I', 2, 0664, "Timer%d", 0),
+                     (7200, 2, 'I', 2, 0664, "Counter%d", 0)]
+               }
+
+# Most modbus/ register files kept in memory at once, over all devices.
+# The least recently used are dropped and made again when next looked up.
+MODBUS_NODE_LIMIT = 256
+
+# Reads queued on a device within this many seconds of each other are
+# grouped, and contiguous addresses fetched with one multi-register read.
+# Zero groups only the reads already waiting in the queue.
+BATCH_SETTINGS = {"window" : 0.0}
+
+# Keep multi-register reads small enough for one USB packet
+MAX_BATCH_REGISTERS = 24
+
+# Writes to DACs and digital IO are held for up to "window" seconds and
+# then sent together, in order, in as few feedback packets as possible.
+# fsync on a file sends them at once. Zero sends every write immediately.
+WRITE_SETTINGS = {"window" : 0.0}
+
+# Most held writes sent in one feedback packet. Each takes at most four
+# bytes of commands, which keeps a packet within one USB transfer.
+MAX_FEEDBACK_WRITES = 12
+
+# Maximum age in seconds of a cached register value, by register class.
+# Zero disables caching for that class. Set with --cache-ttl or the
+# [cache] section of a --config file.
+CACHE_TTLS = {"AIN" : 0, "DAC" : 0, "DIO" : 0, "temperature" : 0}
+
+# Background scanning. With a rate above zero, each device (or only those
+# with serial numbers in "serials") reads all of its connection labels
+# "rate" times a second.
+SCAN_SETTINGS = {"rate" : 0.0, "serials" : []}
+
+# Every value read from a connection, by a scan or otherwise, is kept in a
+# history of the last "depth" samples, shown in the history/ directory.
+HISTORY_SETTINGS = {"depth" : 1000}
+
+# A scanned sample older than this many scan periods is ignored, and the
+# read goes to the device instead.
+STALE_SCANS = 10
+
+# Most scans a stream/data file buffers before it starts dropping the
+# oldest ones
+STREAM_BUFFER_SCANS = 100000
+
+# snapshot.bin starts with this header (magic, layout version, number of
+# values, serial number, reserved, timestamp), followed by one
+# little-endian float64 per value. layout.txt describes it per device.
+SNAPSHOT_BIN_MAGIC = "LJFS"
+SNAPSHOT_BIN_VERSION = 1
+SNAPSHOT_BIN_HEADER = '<4sHHIId'
+
+# Seconds the kernel may cache file attributes and name lookups. Live files
+# are opened with direct_io, so cached attributes never serve old values.
+# Set both to zero to make every lookup and stat reach LJFuse.
+KERNEL_CACHE_SETTINGS = {"attr_timeout" : 10.0, "entry_timeout" : 10.0}
+
+# With "lazy" set, devices are listed at startup but each one is opened,
+# configured and given its directory contents only when something inside
+# its directory is first accessed. Until then its directory is named
+# after its product and serial number. With "rescan" above zero, devices
+# are listed again every "rescan" seconds to pick up ones connected or
+# disconnected since; writing to the top-level rescan file does the same.
+DEVICE_SETTINGS = {"lazy" : False, "rescan" : 0.0}
+
+# Product names by devType, for naming devices that aren't open yet
+PRODUCT_NAMES = {3 : "U3", 6 : "U6", 9 : "UE9"}
+
+# Modbus address of the internal temperature sensor by devType
+TEMPERATURE_ADDRS = {3 : 60, 6 : 28, 9 : 266}
+
+# Most devices opened and configured at the same time at startup
+OPEN_THREADS = 8
+
+# U3 and U6 calibration constants are kept in the file at "path" by serial
+# number and read from the device only when it isn't there, the device's
+# firmware changed, or "refresh" is set. An empty path turns this off.
+CALIBRATION_SETTINGS = {"path" : os.path.join(os.path.expanduser("~"), ".ljfuse-calibration"), "refresh" : False}
+
+def registerClass(addr):
+    """The CACHE_TTLS class of a Modbus address"""
+    if addr < 5000:
+        return "AIN"
+    elif addr < 6000:
+        return "DAC"
+    elif addr < 7000:
+        return "DIO"
+    else:
+        # Timers and counters change on their own, so they're never
+        # cached; "counter" has no entry in CACHE_TTLS
+        return "counter"
+
+def indexRegisters(registerMap):
+    """
+    REGISTER_MAP as a dict of devType to a dict of address to (struct
+    format, width, mode, name)
+    """
+    index = dict()
+    for devType, rows in registerMap.items():
+        registers = index[devType] = dict()
+        for first, count, format, width, mode, name, number in rows:
+            for i in range(count):
+                registers[first + i * width] = (format, width, mode, name % (number + i))
+    return index
+
+REGISTERS = indexRegisters(REGISTER_MAP)
+
+def registerInfo(devType, addr):
+    """(struct format, width, mode, name) of addr, or None if devType has no register there"""
+    return REGISTERS.get(devType, {}).get(addr)
+
+def registerFormat(devType, addr):
+    """struct format of a Modbus address, or None if it isn't in REGISTER_MAP"""
+    info = registerInfo(devType, addr)
+    if info is None:
+        return None
+    return info[0]
+
+def registerWords(devType, run):
+    """
+    The 16-bit words a multi-register write of run, a list of (addr,
+    value) of mapped addresses, sends. Each value is packed by its
+    REGISTER_MAP format, so a float or 32-bit integer takes two words.
+    """
+    words = []
+    for addr, value in run:
+        packed = struct.pack('>' + registerFormat(devType, addr), value)
+        words += struct.unpack('>%dH' % (len(packed) / 2), packed)
+    return words
+
+def contiguousRuns(devType, addrs):
+    """
+    Groups Modbus addresses into runs of adjacent addresses that fit in
+    one multi-register read. Returns a sorted list of runs, each a list of
+    addresses. Addresses not in REGISTER_MAP have unknown widths, so
+    each is a run of its own.
+    """
+    runs = []
+    run = []
+    numReg = 0
+    lastWidth = None
+    for addr in sorted(set(addrs)):
+        info = registerInfo(devType, addr)
+        width = info and info[1]
+        if run:
+            if width is None or lastWidth is None or addr != run[-1] + lastWidth \
+                    or numReg + width > MAX_BATCH_REGISTERS:
+                runs.append(run)
+                run = []
+                numReg = 0
+        run.append(addr)
+        numReg += width or 0
+        lastWidth = width
+    if run:
+        runs.append(run)
+    return runs
+
+def readRun(device, devType, run):
+    """
+    Reads a run of contiguous addresses from contiguousRuns() in one
+    transaction and returns the values in the same order.
+    """
+    infos = [registerInfo(devType, addr) for addr in run]
+    if infos[0] is None:
+        return [device.readRegister(run[0])]
+    format = '>' + ''.join(info[0] for info in infos)
+    numReg = sum(info[1] for info in infos)
+    if len(run) == 1:
+        return [device.readRegister(run[0], numReg = numReg, format = format)]
+    return list(device.readRegister(run[0], numReg = numReg, format = format))
 
 U3_LV_CONNECTION_LABELS = {"DAC0":(5000, 0664), "DAC1": (5002,0664)
                           }
@@ -62,19 +262,79 @@ U3_HV_FLEXIBLE_CONNECTION_LABELS = {
                      "CIO0":16,"CIO1":17,"CIO2":18,"CIO3":19,
                     }
 
-U6_UE9_CONNECTION_LABELS = {"AIN0": (0, 0444), "AIN1":(2,0444), "AIN2":(4,0444), "AIN3":(6,0444),
-                     "DAC0":(5000, 0664), "DAC1": (5002,0664),
-                     "FIO0":(6000, 0664), "FIO1":(6001, 0664), "FIO2":(6002, 0664), "FIO3":(6003, 0664), 
-                     "FIO4":(6004, 0664), "FIO5":(6005, 0664), "FIO6":(6006, 0664), "FIO7":(6007, 0664),    
-                     "FIO0-dir":(6100, 0664), "FIO1-dir":(6101, 0664), "FIO2-dir":(6102, 0664), "FIO3-dir":(6103, 0664), 
-                     "FIO4-dir":(6104, 0664), "FIO5-dir":(6105, 0664), "FIO6-dir":(6106, 0664), "FIO7-dir":(6107, 0664)
-                }
+# Digital ports by name: the IO number of the first line, and the number
+# of lines
+PORT_LINES = {"FIO" : (0, 8), "EIO" : (8, 8), "CIO" : (16, 4)}
+
+# The keyword argument of UE9.feedback() that sets each port's directions
+UE9_DIRECTION_KWARGS = {"FIO" : "FIODir", "EIO" : "EIODir",
+                        "CIO" : "CIODirection", "MIO" : "MIODirection"}
+
+# Digital IO lines of the U6 and UE9 by label: IO number
+U6_UE9_DIGITAL_LINES = dict([("FIO%d" % n, n) for n in range(8)] +
+                            [("EIO%d" % n, 8 + n) for n in range(8)] +
+                            [("CIO%d" % n, 16 + n) for n in range(4)] +
+                            [("MIO%d" % n, 20 + n) for n in range(3)])
+
+# Analog inputs of the U6 and UE9 with a screw terminal or DB37 pin.
+# Channels above these are internal, such as the temperature sensor.
+U6_UE9_ANALOG_INPUTS = 14
+
+# Connection files of each devType but the U3 by label: (Modbus address, mode)
+U6_CONNECTION_LABELS = {"DAC0":(5000, 0664), "DAC1": (5002,0664)}
+U6_CONNECTION_LABELS.update(("AIN%d" % n, (2 * n, 0444)) for n in range(U6_UE9_ANALOG_INPUTS))
+U6_CONNECTION_LABELS.update((label, (6000 + n, 0664)) for label, n in U6_UE9_DIGITAL_LINES.items())
+U6_CONNECTION_LABELS.update((label + "-dir", (6100 + n, 0664)) for label, n in U6_UE9_DIGITAL_LINES.items())
+
+UE9_CONNECTION_LABELS = dict(U6_CONNECTION_LABELS)
+
+CONNECTION_LABELS = {6 : U6_CONNECTION_LABELS, 9 : UE9_CONNECTION_LABELS}
 
 class Path(object):
+    # True for files whose contents change between reads, such as
+    # register values
+    live = False
+    # True for files whose contents never change while mounted
+    static = False
+    # True for files that collect everything written through an open file
+    # and pass it to run() in one piece on the next read, flush or fsync.
+    # Reads through that file then return what run() returned.
+    collectsWrites = False
+
     def __init__(self, parent, myName):
         self.myName = myName
         self.children = []
         self.linkToParent(parent)
+        self.statStruct = None
+        self.dynamicLength = False
+
+    def stat(self):
+        """
+        This node's attributes as a c_stat, built on first use and kept,
+        so getattr doesn't build them on every call. No node's mode or
+        fixed length changes once made. Only st_size is refreshed, and only
+        for files whose length is computed from their contents.
+        """
+        st = self.statStruct
+        if st is None:
+            st = self.statStruct = self.buildStat()
+        elif self.dynamicLength:
+            st.st_size = self.length
+        return st
+
+    def buildStat(self):
+        if self.fileType == "DIR":
+            attrs = dict(st_mode=(S_IFDIR | 0755), st_nlink=2)
+        else:
+            attrs = dict(st_mode=(S_IFREG | getattr(self, "mode", 0444)), st_nlink=1,
+                         st_size=self.length)
+        attrs['st_ctime'] = attrs['st_mtime'] = attrs['st_atime'] = time()
+        attrs['st_uid'] = os.getuid()
+        attrs['st_gid'] = os.getgid()
+        self.dynamicLength = isinstance(getattr(type(self), "length", None), property)
+        st = c_stat()
+        set_st_attrs(st, attrs)
+        return st
 
     def __repr__(self):
         return str(self.__class__) + ": " + self.myName
@@ -83,6 +343,21 @@ class Path(object):
         if parent is not None:
             parent.children.append(self)
 
+    def snapshotAddrs(self):
+        """Modbus addresses a device snapshot must read for this file"""
+        return []
+
+    def snapshotValue(self, values):
+        """
+        This file's value in a device snapshot, given a dict of the
+        addresses read
+        """
+        return None
+
+    def historyAddrs(self):
+        """Every Modbus address this file may read"""
+        return self.snapshotAddrs()
+
     def stripNullBytes(self, data):
         # If data contains a newline, get rid of everything after
         firstNewline = data.find('\n')
@@ -102,16 +377,61 @@ class DeviceNamePath(Path):
         self.fileType = "DIR"
 
 class ModbusOpPath(Path):
-    def __init__(self, parent, myName = "modbus"):
+    def __init__(self, parent, device, myName = "modbus"):
         super(ModbusOpPath, self).__init__(parent, myName)
         self.fileType = "DIR"
+        self.device = device
+        # Addresses outside REGISTER_MAP that were given a file by create
+        self.createdAddrs = set()
+
+    def registerNames(self):
+        """Names of the register files, one per address in REGISTER_MAP or created"""
+        addrs = set(REGISTERS.get(self.device.devType, {})) | self.createdAddrs
+        return [str(addr) for addr in sorted(addrs)]
+
+    def makeRegister(self, name):
+        """
+        A new file for the register called name. It isn't added to
+        children; PathController keeps the ones in use. Raises KeyError if
+        the device has no such register and none was created.
+        """
+        try:
+            addr = int(name)
+        except ValueError:
+            raise KeyError(name)
+        if str(addr) != name:
+            raise KeyError(name)
+        info = registerInfo(self.device.devType, addr)
+        if info is not None:
+            return ModbusAddrPath(None, name, self.device, addr, info[2])
+        if addr in self.createdAddrs:
+            # Untyped; read and written with the driver's defaults
+            return ModbusAddrPath(None, name, self.device, addr, 0664)
+        raise KeyError(name)
+
+    def createRegister(self, name):
+        """
+        Gives an address outside REGISTER_MAP a file. Raises ValueError if
+        name isn't a Modbus address.
+        """
+        addr = int(name)
+        if str(addr) != name or not 0 <= addr <= 0xffff:
+            raise ValueError(name)
+        self.createdAddrs.add(addr)
 
 class ConnectionLabelOpPath(Path):
     def __init__(self, parent, myName = "connection"):
         super(ConnectionLabelOpPath, self).__init__(parent, myName)
         self.fileType = "DIR"
 
+class StreamOpPath(Path):
+    def __init__(self, parent, myName = "stream"):
+        super(StreamOpPath, self).__init__(parent, myName)
+        self.fileType = "DIR"
+
 class ModbusAddrPath(Path):
+    live = True
+
     def __init__(self, parent, myName, device, addr, mode):
         super(ModbusAddrPath, self).__init__(parent, myName)
         self.fileType = "FILE"
@@ -119,10 +439,11 @@ class ModbusAddrPath(Path):
         self.device = device
         self.addr = addr
         self.mode = mode
+        self.cacheClass = registerClass(addr)
 
     def read(self):
         if DEBUG: print "ModbusAddrPath Reading addr " + str(self.addr)
-        readResult = self.device.readRegister(self.addr)
+        readResult = self.device.dispatcher.readRegister(self.addr, self.cacheClass)
         if type(readResult) == type(0.0):
             return '%0.3f\n' % readResult
         else:
@@ -136,36 +457,121 @@ class ModbusAddrPath(Path):
         except ValueError:
             data = float(self.stripNullBytes(data))
         if DEBUG: print "ModbusAddrPath write data =", data
-        self.device.writeRegister(self.addr, data)
+        return self.device.dispatcher.writeRegister(self.addr, data)
+
+    def snapshotAddrs(self):
+        return [self.addr]
+
+    def snapshotValue(self, values):
+        return values.get(self.addr)
+
+class BatchPath(Path):
+    live = True
+    collectsWrites = True
+
+    def __init__(self, parent, device, myName = "batch"):
+        super(BatchPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.length = 0
+        self.mode = 0664
+        self.device = device
+
+    def read(self):
+        return ""
+
+    def run(self, data):
+        """
+        Carries out the `address=value' and `address?' lines in data, in
+        order, as one request to the device. Returns an `address=value'
+        line for each query.
+        """
+        operations = []
+        for lineNumber, line in enumerate(data.replace('\x00', '').splitlines()):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                if line.endswith('?'):
+                    operations.append(('read', int(line[:-1])))
+                else:
+                    addr, value = line.split('=', 1)
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        value = float(value)
+                    operations.append(('write', int(addr), value))
+            except ValueError:
+                raise OSError(EINVAL, "Line %d: %s" % (lineNumber + 1, line))
+            info = registerInfo(self.device.devType, operations[-1][1])
+            if info is not None and operations[-1][0] == 'write' and not info[2] & 0222:
+                raise OSError(EINVAL, "Line %d: %s" % (lineNumber + 1, line))
+
+        try:
+            values = self.device.dispatcher.transact(operations)
+        except Exception, e:
+            if DEBUG: print "BatchPath run failed:", e
+            raise OSError(EIO, str(e))
+
+        addrs = [op[1] for op in operations if op[0] == 'read']
+        lines = []
+        for addr, value in zip(addrs, values):
+            if type(value) == type(0.0):
+                lines.append('%d=%0.3f\n' % (addr, value))
+            else:
+                lines.append('%d=%s\n' % (addr, value))
+        return ''.join(lines)
 
 class TemperaturePath(ModbusAddrPath):
     def __init__(self, parent, myName, device):
         self.device = device
-        if self.device.devType == 3:
-            self.addr = 60
-        elif self.device.devType == 6:
-            self.addr = 28
-        elif self.device.devType == 9:
-            self.addr = 266
+        self.addr = TEMPERATURE_ADDRS[self.device.devType]
         self.mode = 0444
         super(TemperaturePath, self).__init__(parent, myName, device, self.addr, self.mode)
         self.length = 8
+        self.cacheClass = "temperature"
+
+def feedbackDriver(device):
+    """The u3 or u6 module, for building feedback commands; None for a UE9"""
+    if device.devType == 3:
+        import u3
+        return u3
+    elif device.devType == 6:
+        import u6
+        return u6
+    return None
+
+def readFlexibleIOConfig(device):
+    """
+    The state of every flexible IO line on a U3, by IO number: 2 for
+    analog input, otherwise the direction (0 for input, 1 for output).
+    Takes one configIO and one feedback packet for all lines.
+
+    Called while the directory is built, before FUSE daemonizes when
+    mounting, so it talks to the device directly. Going through the
+    dispatcher would start its worker thread in the process that exits.
+    """
+    import u3
+    config = device.configIO()
+    analogInputs = config['FIOAnalog'] + (config['EIOAnalog'] << 8)
+    portDir, = device.getFeedback(u3.PortDirRead())
+    directions = portDir['FIO'] + (portDir['EIO'] << 8) + (portDir['CIO'] << 16)
+    states = dict()
+    for ioNumber in range(20):
+        if (analogInputs >> ioNumber) & 1:
+            states[ioNumber] = 2
+        else:
+            states[ioNumber] = (directions >> ioNumber) & 1
+    return states
 
 class FlexibleIODirPath(Path):
-    def __init__(self, parent, myName, device, ioNumber):
+    def __init__(self, parent, myName, device, ioNumber, state):
         super(FlexibleIODirPath, self).__init__(parent, myName)
         self.fileType = "FILE"
         self.length = 2
         self.mode = 0664
         self.device = device
         self.ioNumber = ioNumber
-        config = self.device.configIO()
-        analogInputs = config['FIOAnalog'] + (config['EIOAnalog'] << 8)
-        if (analogInputs >> self.ioNumber) & 1:
-            self.state = 2
-        else:
-            bitDir, = self.device.getFeedback(u3.BitDirRead(self.ioNumber))
-            self.state = bitDir
+        self.state = state
     
     def read(self):
         return "%d\n" % self.state
@@ -176,12 +582,18 @@ class FlexibleIODirPath(Path):
         except ValueError:
             raise OSError(EACCES, 'Invalid value')
         if self.state == 2:
-            self.device.configAnalog(self.ioNumber)
+            self.device.dispatcher.call(self.device.configAnalog, self.ioNumber)
         else:
-            self.device.configDigital(self.ioNumber)
-            self.device.getFeedback(u3.BitDirWrite(self.ioNumber, self.state))
+            import u3
+            self.device.dispatcher.call(self.device.configDigital, self.ioNumber)
+            self.device.dispatcher.getFeedback(u3.BitDirWrite(self.ioNumber, self.state))
+
+    def snapshotValue(self, values):
+        return self.state
 
 class FlexibleIOStatePath(Path):
+    live = True
+
     def __init__(self, parent, myName, device, ioNumber, flexibleIODirPath):
         super(FlexibleIOStatePath, self).__init__(parent, myName)
         self.fileType = "FILE"
@@ -193,12 +605,18 @@ class FlexibleIOStatePath(Path):
         self.analogModbusAddr = 2 * ioNumber
         self.digitalModbusAddr = 6000 + ioNumber
 
+    def currentAddr(self):
+        if self.dirRef.state == 2:
+            return self.analogModbusAddr
+        else:
+            return self.digitalModbusAddr
+
     def read(self):
         if self.dirRef.state == 2:
-            readResult = self.device.readRegister(self.analogModbusAddr)
+            readResult = self.device.dispatcher.readRegister(self.analogModbusAddr, "AIN")
             return '%0.3f\n' % readResult
         else:
-            readResult = self.device.readRegister(self.digitalModbusAddr)
+            readResult = self.device.dispatcher.readRegister(self.digitalModbusAddr, "DIO")
             return str(readResult).ljust(self.length - 1) + '\n'
 
     def write(self, data):
@@ -206,9 +624,136 @@ class FlexibleIOStatePath(Path):
             data = int(self.stripNullBytes(data))
         except ValueError:
             data = float(self.stripNullBytes(data))
-        self.device.writeRegister(self.digitalModbusAddr, data)
+        return self.device.dispatcher.writeRegister(self.digitalModbusAddr, data)
+
+    def snapshotAddrs(self):
+        return [self.currentAddr()]
+
+    def historyAddrs(self):
+        return [self.analogModbusAddr, self.digitalModbusAddr]
+
+    def snapshotValue(self, values):
+        return values.get(self.currentAddr())
+
+class PortPath(Path):
+    """
+    A whole digital port as a number, bit n for line n of the port, read
+    or written with one feedback command. With direction, the bits are
+    directions (1 for output) rather than states. Writing states changes
+    only the lines that are outputs.
+    """
+    live = True
+
+    def __init__(self, parent, myName, device, port, direction, dirPaths):
+        super(PortPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.length = 6
+        self.mode = 0664
+        self.device = device
+        self.port = port
+        self.direction = direction
+        self.firstLine, self.numLines = PORT_LINES[port]
+        # U3 FlexibleIODirPaths by IO number, kept in step with writes to
+        # the direction port
+        self.dirPaths = dirPaths
+
+    def portIndex(self):
+        return ["FIO", "EIO", "CIO"].index(self.port)
+
+    def read(self):
+        driver = feedbackDriver(self.device)
+        if driver is None:
+            result = self.device.dispatcher.query(self.device.feedback)
+            value = result[self.port + ("Dir" if self.direction else "State")]
+        else:
+            if self.direction:
+                command = driver.PortDirRead()
+            else:
+                command = driver.PortStateRead()
+            result, = self.device.dispatcher.query(self.device.getFeedback, command)
+            value = result[self.port]
+        value &= (1 << self.numLines) - 1
+        return str(value).ljust(self.length - 1) + '\n'
+
+    def write(self, data):
+        try:
+            value = int(self.stripNullBytes(data), 0)
+        except ValueError:
+            raise OSError(EACCES, 'Invalid value')
+        mask = (1 << self.numLines) - 1
+        if value < 0 or value > mask:
+            raise OSError(EACCES, 'Invalid value')
+
+        driver = feedbackDriver(self.device)
+        if driver is None:
+            self.device.dispatcher.call(self.writeUE9, value, mask)
+        else:
+            values = [0, 0, 0]
+            masks = [0, 0, 0]
+            values[self.portIndex()] = value
+            masks[self.portIndex()] = mask
+            if self.direction:
+                command = driver.PortDirWrite(Direction = values, WriteMask = masks)
+            else:
+                command = driver.PortStateWrite(State = values, WriteMask = masks)
+            self.device.dispatcher.getFeedback(command)
+
+        if self.direction:
+            for ioNumber, dirPath in self.dirPaths.items():
+                if dirPath.state != 2:
+                    dirPath.state = (value >> (ioNumber - self.firstLine)) & 1
+
+    def writeUE9(self, value, mask):
+        # Runs on the dispatcher's worker. A UE9 feedback write sets both
+        # the direction and the state of the masked lines, so keep the one
+        # not being written.
+        current = self.device.feedback()
+        if self.direction:
+            direction, state = value, current[self.port + "State"]
+        else:
+            direction, state = current[self.port + "Dir"], value
+        kwargs = { self.port + "Mask" : mask, UE9_DIRECTION_KWARGS[self.port] : direction, self.port + "State" : state }
+        self.device.feedback(**kwargs)
+
+class AnalogInputsPath(Path):
+    """
+    Every analog input of a U6 or UE9, one `AINn volts' line each, read
+    with one feedback command
+    """
+    live = True
+
+    def __init__(self, parent, device, myName = "AIN"):
+        super(AnalogInputsPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.length = 14 * U6_UE9_ANALOG_INPUTS
+        self.mode = 0444
+        self.device = device
+
+    def read(self):
+        readTime = time()
+        channels = range(U6_UE9_ANALOG_INPUTS)
+        if self.device.devType == 6:
+            import u6
+            commands = [u6.AIN24(PositiveChannel = n) for n in channels]
+            results = self.device.dispatcher.query(self.device.getFeedback, *commands)
+            values = [self.device.binaryToCalibratedAnalogVoltage(0, bits, is16Bits = False) for bits in results]
+        else:
+            result = self.device.dispatcher.query(self.readUE9)
+            values = [result["AIN%d" % n] for n in channels]
+        lines = []
+        for n, value in zip(channels, values):
+            self.device.dispatcher.recordSample(2 * n, readTime, value)
+            lines.append("%-5s %7.3f\n" % ("AIN%d" % n, value))
+        return ''.join(lines)
+
+    def readUE9(self):
+        # Runs on the dispatcher's worker. No masks are set, so no outputs
+        # change.
+        return self.device.feedback(AINMask = (1 << U6_UE9_ANALOG_INPUTS) - 1)
 
 class DeviceAttributePath(Path):
+    static = True
+
     def __init__(self, parent, myName, device, attr):
         super(DeviceAttributePath, self).__init__(parent, myName)
         self.fileType = "FILE"
@@ -219,7 +764,231 @@ class DeviceAttributePath(Path):
         if DEBUG: print "DeviceAttributePath Reading attr " + self.myAttrValue
         return self.myAttrValue
 
+class StreamControlPath(Path):
+    live = True
+
+    def __init__(self, parent, device, myName = "control"):
+        super(StreamControlPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.mode = 0664
+        self.device = device
+
+    @property
+    def length(self):
+        return len(self.read())
+
+    def read(self):
+        return self.device.streamer.status()
+
+    def write(self, data):
+        data = self.stripNullBytes(data).strip()
+        if data == "stop":
+            self.device.streamer.stop()
+            return
+        try:
+            channels, rate = data.split()
+            channels = [int(c) for c in channels.split(',')]
+            rate = float(rate)
+        except ValueError:
+            raise OSError(EACCES, 'Invalid value')
+        try:
+            self.device.streamer.start(channels, rate)
+        except Exception, e:
+            # Left to fusepy, the driver's error would come back as EFAULT
+            if DEBUG: print "StreamControlPath couldn't start stream:", e
+            raise OSError(EIO, str(e))
+
+class StreamDataPath(Path):
+    def __init__(self, parent, device, myName = "data"):
+        super(StreamDataPath, self).__init__(parent, myName)
+        # Has no fixed length; read() returns whatever has been streamed
+        self.fileType = "STREAM"
+        self.length = 0
+        self.mode = 0444
+        self.device = device
+
+    def read(self, size):
+        return self.device.streamer.read(size)
+
+def takeSnapshot(device, fields):
+    """
+    Reads every field, a list of (label, Path), of a device in as few
+    multi-register reads as possible. Returns (timestamp, [(label, value)]).
+    A value is None if its address couldn't be read.
+    """
+    addrs = []
+    for label, pathObj in fields:
+        addrs += pathObj.snapshotAddrs()
+    timestamp = time()
+    values = device.dispatcher.readRegisters(addrs)
+    return timestamp, [(label, pathObj.snapshotValue(values)) for label, pathObj in fields]
+
+def snapshotBinFormat(fields):
+    return SNAPSHOT_BIN_HEADER + '%dd' % len(fields)
+
+def snapshotLayout(fields):
+    """The text of layout.txt, which documents snapshot.bin"""
+    format = snapshotBinFormat(fields)
+    headerSize = struct.calcsize(SNAPSHOT_BIN_HEADER)
+    lines = ["",
+             "LJFuse layout.txt: snapshot.bin layout",
+             "======================================",
+             "",
+             "  snapshot.bin is %d bytes, little-endian:" % struct.calcsize(format),
+             "",
+             "    Offset  Type     Field",
+             "    ------  -------  -----------------------------------",
+             "    0       char[4]  magic, \"%s\"" % SNAPSHOT_BIN_MAGIC,
+             "    4       uint16   layout version, %d" % SNAPSHOT_BIN_VERSION,
+             "    6       uint16   number of values, %d" % len(fields),
+             "    8       uint32   serial number",
+             "    12      uint32   reserved, 0",
+             "    16      float64  timestamp, seconds since the epoch"]
+    for i, (label, pathObj) in enumerate(fields):
+        lines.append("    %-6d  float64  %s" % (headerSize + 8 * i, label))
+    lines += ["",
+              "  Values that couldn't be read are NaN. To decode it:",
+              "",
+              "    Python: struct.unpack('%s', data)" % format,
+              "    NumPy:  numpy.frombuffer(data, '<f8', offset=%d)" % headerSize,
+              ""]
+    return '\n'.join(lines)
+
+class SnapshotPath(Path):
+    """
+    Every connection of a device, read together and stamped with one time,
+    as JSON, as a CSV header and row, or packed as described by
+    snapshotLayout().
+    """
+    live = True
+
+    def __init__(self, parent, myName, device, fields, format):
+        super(SnapshotPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.mode = 0444
+        # The device's directory. Its name is the one the snapshot reports,
+        # so reading it doesn't read the name register from the device.
+        self.deviceNamePath = parent
+        self.device = device
+        self.fields = fields
+        self.format = format
+        if format == "bin":
+            self.length = struct.calcsize(snapshotBinFormat(fields))
+        else:
+            # Upper bound; reads return the actual contents
+            self.length = 256 + 48 * len(fields)
+
+    def read(self):
+        timestamp, values = takeSnapshot(self.device, self.fields)
+        if self.format == "bin":
+            floats = []
+            for label, value in values:
+                if value is None:
+                    floats.append(float('nan'))
+                else:
+                    floats.append(float(value))
+            return struct.pack(snapshotBinFormat(self.fields), SNAPSHOT_BIN_MAGIC,
+                SNAPSHOT_BIN_VERSION, len(floats), int(self.device.serialNumber), 0,
+                timestamp, *floats)
+        elif self.format == "json":
+            snapshot = dict(name = self.deviceNamePath.myName,
+                            serialNumber = self.device.serialNumber,
+                            timestamp = timestamp,
+                            values = dict(values))
+            return json.dumps(snapshot, sort_keys = True) + '\n'
+        else:
+            header = ["timestamp"] + [label for label, value in values]
+            row = [repr(timestamp)]
+            for label, value in values:
+                if value is None:
+                    row.append('')
+                else:
+                    row.append(repr(value))
+            return ','.join(header) + '\n' + ','.join(row) + '\n'
+
+class HistoryOpPath(Path):
+    def __init__(self, parent, myName = "history"):
+        super(HistoryOpPath, self).__init__(parent, myName)
+        self.fileType = "DIR"
+
+class HistoryPath(Path):
+    """
+    The samples kept for one connection, oldest first. As CSV, a header
+    then one "timestamp,value" line per sample; as bin, little-endian
+    float64 (timestamp, value) pairs.
+    """
+    live = True
+
+    def __init__(self, parent, myName, device, connectionPath, format):
+        super(HistoryPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.mode = 0444
+        self.device = device
+        self.connectionPath = connectionPath
+        self.format = format
+
+    @property
+    def length(self):
+        buf = self.buffer()
+        if buf is None:
+            count = 0
+        else:
+            count = len(buf)
+        if self.format == "bin":
+            return 16 * count
+        else:
+            # Upper bound; reads return the actual contents
+            return 32 + 48 * count
+
+    def buffer(self):
+        addrs = self.connectionPath.snapshotAddrs()
+        if not addrs:
+            return None
+        return self.device.dispatcher.history.get(addrs[0])
+
+    def read(self):
+        # LJFuse.read keeps what this returns for the open file and slices
+        # it, so a large history is built once per open, not once per read.
+        buf = self.buffer()
+        if buf is None:
+            times, values = array('d'), array('d')
+        else:
+            times, values = buf.ordered()
+        if self.format == "bin":
+            pairs = array('d', [0.0]) * (2 * len(times))
+            pairs[0::2] = times
+            pairs[1::2] = values
+            if sys.byteorder != "little":
+                pairs.byteswap()
+            return pairs.tostring()
+        else:
+            integral = registerFormat(self.device.devType, self.connectionPath.snapshotAddrs()[0]) in ('H', 'I')
+            lines = ["timestamp,%s\n" % self.connectionPath.myName]
+            for timestamp, value in zip(times, values):
+                if integral:
+                    lines.append("%r,%d\n" % (timestamp, value))
+                else:
+                    lines.append("%r,%r\n" % (timestamp, value))
+            return ''.join(lines)
+
+class IOStatsPath(Path):
+    live = True
+
+    def __init__(self, parent, device, myName = "ioStats"):
+        super(IOStatsPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.device = device
+
+    @property
+    def length(self):
+        return len(self.read())
+
+    def read(self):
+        return ''.join("%s %s\n" % (k, v) for k, v in self.device.dispatcher.stats())
+
 class ReadmePath(Path):
+    static = True
+
     def __init__(self, parent, readmeStr, myName = "README.txt"):
         super(ReadmePath, self).__init__(parent, myName)
         self.fileType = "FILE"
@@ -229,9 +998,35 @@ class ReadmePath(Path):
     def read(self):
         return self.readmeStr
 
+class RescanPath(Path):
+    live = True
+
+    def __init__(self, parent, pathController, myName = "rescan"):
+        super(RescanPath, self).__init__(parent, myName)
+        self.fileType = "FILE"
+        self.length = 0
+        self.mode = 0222
+        self.pathController = pathController
+
+    def read(self):
+        return ""
+
+    def write(self, data):
+        self.pathController.rescan()
+
 class PathController(object):
     def __init__(self, dm):
         self.dm = dm
+        self.loadLock = threading.Lock()
+        self.rescanThread = None
+        # modbus/ register files by (ModbusOpPath, name), least recently
+        # used first
+        self.modbusNodes = OrderedDict()
+        self.modbusLock = threading.Lock()
+        # Directory names of pending devices that were opened and moved to
+        # their own names, mapped to those names, so paths already handed
+        # out under the old name keep working
+        self.aliases = dict()
         self.buildPathDict()
     
     def buildPathDict(self):
@@ -242,79 +1037,342 @@ class PathController(object):
         self.pathDict['/README.txt'] = topLevelReadme
         howToUnmountDoc = ReadmePath(rootPath, howToUnmount(), myName="HOW_TO_UNMOUNT.txt")
         self.pathDict['/HOW_TO_UNMOUNT.txt'] = howToUnmountDoc
+        rescanPath = RescanPath(rootPath, self)
+        self.pathDict['/rescan'] = rescanPath
+
+        for name in self.dm.names():
+            self.addDevice(name)
+        for name in self.dm.pendingByName.keys():
+            self.addPendingDevice(name)
+
+        if DEBUG: print "PathController buildPathDict self.pathDict =", self.pathDict
+
+    def childEntries(self, pathObj):
+        """
+        (name, stat, offset) for '.', '..' and every child of a directory,
+        so a listing returns attributes along with names. offset is the
+        entry's position, so a large directory can be listed over several
+        readdir calls.
+        """
+        entries = [('.', pathObj.stat(), 1), ('..', None, 2)]
+        # Copy the list, since a rescan may add or remove devices meanwhile
+        for i, child in enumerate(list(pathObj.children)):
+            entries.append((child.myName, child.stat(), i + 3))
+        if isinstance(pathObj, ModbusOpPath):
+            # Without attributes, so listing doesn't make every file
+            for name in pathObj.registerNames():
+                entries.append((name, None, len(entries) + 1))
+        return entries
+
+    def subtreeKeys(self, prefix):
+        """Keys of pathDict at or below prefix"""
+        return [key for key in self.pathDict.keys() if key == prefix or key.startswith(prefix + '/')]
+
+    def lookup(self, path, listing = False):
+        """
+        pathDict[path], after loading the device if path is inside the
+        directory of a pending device. Looking up the directory itself
+        doesn't load it unless listing, so listing / opens nothing.
+        Register files in modbus/ aren't in pathDict; they're made here.
+        """
+        parts = path.split('/')
+        if parts[1] in self.aliases:
+            parts[1] = self.aliases[parts[1]]
+            path = '/'.join(parts)
+        if len(parts) > 2 or listing:
+            name = parts[1]
+            if name in self.dm.pendingByName:
+                parts[1] = self.loadDevice(name)
+                path = '/'.join(parts)
+        try:
+            return self.pathDict[path]
+        except KeyError:
+            if len(parts) != 4 or parts[2] != "modbus":
+                raise
+        return self.modbusNode(self.pathDict['/' + parts[1] + '/modbus'], parts[3])
 
-        names = self.dm.names()
-        for name in names:
+    def modbusNode(self, modbusOpPath, name):
+        """
+        The file for the register called name in modbusOpPath, made on
+        first use. At most MODBUS_NODE_LIMIT are kept; the least recently
+        used is dropped to make room.
+        """
+        key = (modbusOpPath, name)
+        self.modbusLock.acquire()
+        try:
+            node = self.modbusNodes.pop(key, None)
+            if node is None:
+                node = modbusOpPath.makeRegister(name)
+                while len(self.modbusNodes) >= MODBUS_NODE_LIMIT:
+                    self.modbusNodes.popitem(last = False)
+            self.modbusNodes[key] = node
+            return node
+        finally:
+            self.modbusLock.release()
+
+    def loadDevice(self, name):
+        """
+        Opens a pending device and fills in its directory, which moves to
+        the name the device was opened under. Returns that name.
+        """
+        self.loadLock.acquire()
+        try:
+            if name not in self.dm.pendingByName:
+                # Another thread loaded it while we waited
+                return self.aliases.get(name, name)
+            try:
+                newName = self.dm.openPending(name)
+            except Exception, e:
+                if DEBUG: print "PathController loadDevice couldn't open %s: %s" % (name, e)
+                raise OSError(EIO, str(e))
+            if newName != name:
+                self.moveSubtree(name, newName)
+                self.aliases.pop(newName, None)
+                self.aliases[name] = newName
+            self.buildDevice(newName)
+            self.dm.pendingByName.pop(name)
+            return newName
+        finally:
+            self.loadLock.release()
+
+    def rescan(self):
+        """
+        Lists the devices again, and adds or removes the directories of
+        those connected or disconnected since. A device that stopped
+        answering and was opened again under the same name gets a new
+        directory. Other devices' directories and open files aren't
+        touched.
+        """
+        self.loadLock.acquire()
+        try:
+            before = set(self.dm.names()) | set(self.dm.pendingByName)
+            devicesBefore = dict(self.dm.deviceByName)
+            self.dm.updateDeviceDict()
+            after = set(self.dm.names()) | set(self.dm.pendingByName)
+            for name in before - after:
+                if DEBUG: print "PathController rescan removing", name
+                self.removeDevice(name)
+            for name in before & after:
+                if self.dm.deviceByName.get(name) is not devicesBefore.get(name):
+                    if DEBUG: print "PathController rescan replacing", name
+                    self.removeDevice(name)
+                    self.addListedDevice(name)
+            for name in after - before:
+                if DEBUG: print "PathController rescan adding", name
+                self.addListedDevice(name)
+        finally:
+            self.loadLock.release()
+
+    def addListedDevice(self, name):
+        """Adds the directory of a device the DeviceManager lists, pending or open"""
+        if name in self.dm.pendingByName:
+            self.addPendingDevice(name)
+        else:
+            self.addDevice(name)
+
+    def startRescans(self):
+        """Rescans every DEVICE_SETTINGS["rescan"] seconds, if set"""
+        if DEVICE_SETTINGS["rescan"] > 0 and self.rescanThread is None:
+            self.rescanThread = threading.Thread(target=self._rescanLoop)
+            self.rescanThread.setDaemon(True)
+            self.rescanThread.start()
+
+    def _rescanLoop(self):
+        while True:
+            sleep(DEVICE_SETTINGS["rescan"])
+            try:
+                self.rescan()
+            except Exception, e:
+                if DEBUG: print "PathController rescan error:", e
+
+    def addPendingDevice(self, name):
+        """Adds an empty directory for a device that isn't open yet"""
+        self.aliases.pop(name, None)
+        self.pathDict['/' + name] = DeviceNamePath(self.pathDict['/'], name)
+
+    def addDevice(self, name):
+        """Builds the subtree for one device and adds it under /"""
+        self.addPendingDevice(name)
+        self.buildDevice(name)
+
+    def buildDevice(self, name):
+        """Fills in the directory of an opened device"""
+        # /device name/
+        deviceNamePath = self.pathDict['/' + name]
+        deviceLevelReadme = ReadmePath(deviceNamePath, DEVICE_LEVEL_README)
+        self.pathDict['/' + name + "/README.txt"] = deviceLevelReadme
+        thisDevice = self.dm.deviceByName[name]
         
-            # /device name/
-            deviceNamePath = DeviceNamePath(rootPath, name)
-            self.pathDict['/' + name] = deviceNamePath
-            deviceLevelReadme = ReadmePath(deviceNamePath, DEVICE_LEVEL_README)
-            self.pathDict['/' + name + "/README.txt"] = deviceLevelReadme
-            thisDevice = self.dm.deviceByName[name]
-            
-            # /device name/serialNumber
-            serialNumberPath = DeviceAttributePath(deviceNamePath, "serialNumber", thisDevice, "serialNumber")
-            self.pathDict['/' + name + "/serialNumber"] = serialNumberPath
-            
-            # /device name/firmwareVersion
-            firmwareVersionPath = DeviceAttributePath(deviceNamePath, "firmwareVersion", thisDevice, "firmwareVersion")
-            self.pathDict['/' + name + "/firmwareVersion"] = firmwareVersionPath
+        # /device name/serialNumber
+        serialNumberPath = DeviceAttributePath(deviceNamePath, "serialNumber", thisDevice, "serialNumber")
+        self.pathDict['/' + name + "/serialNumber"] = serialNumberPath
+        
+        # /device name/firmwareVersion
+        firmwareVersionPath = DeviceAttributePath(deviceNamePath, "firmwareVersion", thisDevice, "firmwareVersion")
+        self.pathDict['/' + name + "/firmwareVersion"] = firmwareVersionPath
 
-            # /device name/internalTemperature
-            internalTemperaturePath = TemperaturePath(deviceNamePath, "internalTemperature", thisDevice)
-            self.pathDict['/' + name + "/internalTemperature"] = internalTemperaturePath
-            
-            # /device name/modbus
-            modbusOpPath = ModbusOpPath(deviceNamePath)
-            self.pathDict['/' + name + "/modbus"] = modbusOpPath
-            modbusLevelReadme = ReadmePath(modbusOpPath, MODBUS_LEVEL_README)
-            self.pathDict['/' + name + "/modbus/README.txt"] = modbusLevelReadme
-            for addr, mode in MODBUS_ADDRS.items():
-                modbusAddrPath = ModbusAddrPath(modbusOpPath, addr, thisDevice, int(addr), mode)
-                self.pathDict['/' + name + "/modbus/" + addr] = modbusAddrPath
-                
-            # /device name/connection
-            connectionLabelOpPath = ConnectionLabelOpPath(deviceNamePath)
-            self.pathDict['/' + name + "/connection"] = connectionLabelOpPath
-            connectionLevelReadme = ReadmePath(connectionLabelOpPath, CONNECTION_LEVEL_README)
-            self.pathDict['/' + name + "/connection/README.txt"] = connectionLevelReadme
+        # /device name/ioStats
+        ioStatsPath = IOStatsPath(deviceNamePath, thisDevice)
+        self.pathDict['/' + name + "/ioStats"] = ioStatsPath
+
+        # /device name/internalTemperature
+        internalTemperaturePath = TemperaturePath(deviceNamePath, "internalTemperature", thisDevice)
+        self.pathDict['/' + name + "/internalTemperature"] = internalTemperaturePath
+        
+        # /device name/modbus
+        modbusOpPath = ModbusOpPath(deviceNamePath, thisDevice)
+        self.pathDict['/' + name + "/modbus"] = modbusOpPath
+        modbusLevelReadme = ReadmePath(modbusOpPath, MODBUS_LEVEL_README)
+        self.pathDict['/' + name + "/modbus/README.txt"] = modbusLevelReadme
+        batchPath = BatchPath(modbusOpPath, thisDevice)
+        self.pathDict['/' + name + "/modbus/batch"] = batchPath
             
-            # /device name/connection/*
-            if thisDevice.devType == 3:
-                if thisDevice.deviceName == "U3-HV":
-                    for label, t in U3_HV_CONNECTION_LABELS.items():
-                        addr, mode = t
-                        connectionLabelPath = ModbusAddrPath(connectionLabelOpPath, label, thisDevice, int(addr), mode)
-                        self.pathDict['/' + name + "/connection/" + label] = connectionLabelPath
-                    flexibleConnectionLabels = U3_HV_FLEXIBLE_CONNECTION_LABELS
-                else:
-                    for label, t in U3_LV_CONNECTION_LABELS.items():
-                        addr, mode = t
-                        connectionLabelPath = ModbusAddrPath(connectionLabelOpPath, label, thisDevice, int(addr), mode)
-                        self.pathDict['/' + name + "/connection/" + label] = connectionLabelPath
-                    flexibleConnectionLabels = U3_LV_FLEXIBLE_CONNECTION_LABELS
-                for label, ioNumber in flexibleConnectionLabels.items():
-                    dirLabel = label + "-dir"
-                    flexibleIODirPath = FlexibleIODirPath(connectionLabelOpPath, dirLabel, thisDevice, ioNumber)
-                    self.pathDict['/' + name + "/connection/" + dirLabel] = flexibleIODirPath
-                    flexibleIOStatePath = FlexibleIOStatePath(connectionLabelOpPath, label, thisDevice, ioNumber, flexibleIODirPath)
-                    self.pathDict['/' + name + "/connection/" + label] = flexibleIOStatePath
+        # /device name/stream
+        streamOpPath = StreamOpPath(deviceNamePath)
+        self.pathDict['/' + name + "/stream"] = streamOpPath
+        streamLevelReadme = ReadmePath(streamOpPath, STREAM_LEVEL_README)
+        self.pathDict['/' + name + "/stream/README.txt"] = streamLevelReadme
+        streamControlPath = StreamControlPath(streamOpPath, thisDevice)
+        self.pathDict['/' + name + "/stream/control"] = streamControlPath
+        streamDataPath = StreamDataPath(streamOpPath, thisDevice)
+        self.pathDict['/' + name + "/stream/data"] = streamDataPath
+
+        # /device name/connection
+        connectionLabelOpPath = ConnectionLabelOpPath(deviceNamePath)
+        self.pathDict['/' + name + "/connection"] = connectionLabelOpPath
+        connectionLevelReadme = ReadmePath(connectionLabelOpPath, CONNECTION_LEVEL_README)
+        self.pathDict['/' + name + "/connection/README.txt"] = connectionLevelReadme
+        
+        # /device name/connection/*
+        if thisDevice.devType == 3:
+            if thisDevice.deviceName == "U3-HV":
+                for label, t in U3_HV_CONNECTION_LABELS.items():
+                    addr, mode = t
+                    connectionLabelPath = ModbusAddrPath(connectionLabelOpPath, label, thisDevice, int(addr), mode)
+                    self.pathDict['/' + name + "/connection/" + label] = connectionLabelPath
+                flexibleConnectionLabels = U3_HV_FLEXIBLE_CONNECTION_LABELS
             else:
-                for label, t in U6_UE9_CONNECTION_LABELS.items():
+                for label, t in U3_LV_CONNECTION_LABELS.items():
                     addr, mode = t
                     connectionLabelPath = ModbusAddrPath(connectionLabelOpPath, label, thisDevice, int(addr), mode)
                     self.pathDict['/' + name + "/connection/" + label] = connectionLabelPath
-
-
-        if DEBUG: print "PathController buildPathDict self.pathDict =", self.pathDict
-
-    def childrenNames(self, pathObj):
-        return [c.myName for c in pathObj.children]
+                flexibleConnectionLabels = U3_LV_FLEXIBLE_CONNECTION_LABELS
+            flexibleIOConfig = readFlexibleIOConfig(thisDevice)
+            for label, ioNumber in flexibleConnectionLabels.items():
+                dirLabel = label + "-dir"
+                flexibleIODirPath = FlexibleIODirPath(connectionLabelOpPath, dirLabel, thisDevice, ioNumber, flexibleIOConfig[ioNumber])
+                self.pathDict['/' + name + "/connection/" + dirLabel] = flexibleIODirPath
+                flexibleIOStatePath = FlexibleIOStatePath(connectionLabelOpPath, label, thisDevice, ioNumber, flexibleIODirPath)
+                self.pathDict['/' + name + "/connection/" + label] = flexibleIOStatePath
+        else:
+            for label, t in CONNECTION_LABELS[thisDevice.devType].items():
+                addr, mode = t
+                connectionLabelPath = ModbusAddrPath(connectionLabelOpPath, label, thisDevice, int(addr), mode)
+                self.pathDict['/' + name + "/connection/" + label] = connectionLabelPath
+
+        # /device name/snapshot.json, snapshot.csv and snapshot.bin
+        snapshotFields = [("internalTemperature", internalTemperaturePath)]
+        snapshotFields += sorted((c.myName, c) for c in connectionLabelOpPath.children if c is not connectionLevelReadme)
+        for format in ("json", "csv", "bin"):
+            snapshotPath = SnapshotPath(deviceNamePath, "snapshot." + format, thisDevice, snapshotFields, format)
+            self.pathDict['/' + name + "/snapshot." + format] = snapshotPath
+
+        # /device name/history
+        historyOpPath = HistoryOpPath(deviceNamePath)
+        self.pathDict['/' + name + "/history"] = historyOpPath
+        historyLevelReadme = ReadmePath(historyOpPath, HISTORY_LEVEL_README)
+        self.pathDict['/' + name + "/history/README.txt"] = historyLevelReadme
+        for label, pathObj in snapshotFields:
+            addrs = pathObj.historyAddrs()
+            if not addrs:
+                continue
+            thisDevice.dispatcher.trackHistory(addrs)
+            for format in ("csv", "bin"):
+                historyPath = HistoryPath(historyOpPath, label + "." + format, thisDevice, pathObj, format)
+                self.pathDict['/' + name + "/history/" + label + "." + format] = historyPath
+
+        # /device name/layout.txt
+        layoutPath = ReadmePath(deviceNamePath, snapshotLayout(snapshotFields), myName="layout.txt")
+        self.pathDict['/' + name + "/layout.txt"] = layoutPath
+
+        # /device name/connection/FIO, EIO, CIO and their -dir files. Added
+        # after the snapshot fields are chosen, since they only repeat the
+        # single lines.
+        dirPaths = dict()
+        for pathObj in connectionLabelOpPath.children:
+            if isinstance(pathObj, FlexibleIODirPath):
+                dirPaths[pathObj.ioNumber] = pathObj
+        for port, (firstLine, numLines) in PORT_LINES.items():
+            portDirPaths = dict((n, p) for n, p in dirPaths.items() if firstLine <= n < firstLine + numLines)
+            for label, direction in ((port, False), (port + "-dir", True)):
+                portPath = PortPath(connectionLabelOpPath, label, thisDevice, port, direction, portDirPaths)
+                self.pathDict['/' + name + "/connection/" + label] = portPath
+
+        # /device name/connection/AIN, every analog input at once
+        if thisDevice.devType in (6, 9):
+            analogInputsPath = AnalogInputsPath(connectionLabelOpPath, thisDevice)
+            self.pathDict['/' + name + "/connection/AIN"] = analogInputsPath
+
+    def removeDevice(self, name):
+        """Removes one device's subtree"""
+        prefix = '/' + name
+        deviceNamePath = self.pathDict[prefix]
+        self.pathDict['/'].children.remove(deviceNamePath)
+        modbusOpPath = self.pathDict.get(prefix + '/modbus')
+        for key in self.subtreeKeys(prefix):
+            del self.pathDict[key]
+        self.dropAliases(name)
+        if modbusOpPath is not None:
+            self.modbusLock.acquire()
+            try:
+                for key in [key for key in self.modbusNodes if key[0] is modbusOpPath]:
+                    del self.modbusNodes[key]
+            finally:
+                self.modbusLock.release()
 
     def renameDevice(self, old, new):
-        self.dm.renameDevice(old, new)
-        self.buildPathDict()
+        """
+        Renames a device by re-keying its subtree in place. Nothing is
+        rebuilt, so no other device is touched and no device I/O happens.
+        Holds loadLock, so a rescan or the loading of a pending device
+        doesn't see the device half renamed.
+        """
+        self.loadLock.acquire()
+        try:
+            # Opening a pending device may have moved it to its own name
+            old = self.aliases.get(old, old)
+            if '/' + old not in self.pathDict:
+                # Removed by a rescan meanwhile
+                raise OSError(ENOENT, '')
+            if old == new:
+                return
+            if '/' + new in self.pathDict:
+                raise OSError(EEXIST, "A device has that name")
+            self.dm.renameDevice(old, new)
+            self.moveSubtree(old, new)
+            self.dropAliases(old)
+            self.aliases.pop(new, None)
+        finally:
+            self.loadLock.release()
+
+    def moveSubtree(self, old, new):
+        """Re-keys a device's subtree in pathDict from old to new"""
+        oldPrefix = '/' + old
+        newPrefix = '/' + new
+        keys = self.subtreeKeys(oldPrefix)
+        # Add the new keys before dropping the old ones, so lookups from
+        # other threads find the device under one name or the other.
+        for key in keys:
+            self.pathDict[newPrefix + key[len(oldPrefix):]] = self.pathDict[key]
+        for key in keys:
+            del self.pathDict[key]
+        self.pathDict[newPrefix].myName = new
+
+    def dropAliases(self, name):
+        """Forgets the old names that lead to name"""
+        for alias, target in self.aliases.items():
+            if target == name:
+                del self.aliases[alias]
 
 def howToUnmount():
     unmountStr = """
@@ -346,19 +1404,21 @@ Step 2. Eject it from the Finder or run
 TOP_LEVEL_README = """
 LJFuse README.txt: Top level
 ============================
-  At this level, there is one directory for every LabJack that LJFuse found
-  when it started. Change to a directory to use that LabJack.
+  At this level, there is one directory for every LabJack that LJFuse
+  found. Change to a directory to use that LabJack.
   
-  Note: Restart LJFuse after disconnecting or reconnecting devices. LJFuse
-  doesn't directly support hot-swapping. See the file HOW_TO_UNMOUNT.txt
-  for instructions on how to restart LJFuse.
+  Note: After connecting or disconnecting devices, write to the rescan
+  file to update the directories, or start LJFuse with --rescan SECONDS to
+  do it automatically. Devices that stay connected keep working meanwhile.
+
+    $ echo > rescan
 
   LJFuse can connect to LabJack devices opened through LJSocket. See
   http://labjack.com/support/python/ljsocket
 
   Example:
     $ ls
-    HOW_TO_UNMOUNT.txt  My U6/  README.txt
+    HOW_TO_UNMOUNT.txt  My U6/  README.txt  rescan
     $ cd "My U6/"
 
 """
@@ -369,15 +1429,24 @@ LJFuse README.txt: Device level
 
   At this level, LJFuse lists the different ways of communicating with a
   LabJack device. The connection/ subdirectory contains files to access
-  individual connections on a LabJack, and the modbus/ subdirectory
-  contains files to access individual Modbus addresses. Files in this
+  individual connections on a LabJack, the modbus/ subdirectory
+  contains files to access individual Modbus addresses, the stream/
+  subdirectory streams analog inputs at high rates, and the history/
+  subdirectory holds recent values of each connection. Files in this
   directory contains device-wide info, such as serial number and firmware
-  version.
+  version. snapshot.json, snapshot.csv and snapshot.bin read every
+  connection at once, with one timestamp for all of them. layout.txt
+  describes the binary format of snapshot.bin. The ioStats file counts the requests and hardware transactions
+  LJFuse has made to the device and how long callers waited for them,
+  and the hits and misses of the read cache (see --cache-ttl).
   
   Example:
     $ ls
-    README.txt           firmwareVersion      modbus/
-    connection/          internalTemperature  serialNumber
+    README.txt           internalTemperature  snapshot.bin
+    connection/          ioStats              snapshot.csv
+    firmwareVersion      layout.txt           snapshot.json
+    history/             modbus/              stream/
+    serialNumber
     $ cat firmwareVersion
     1.15
     $ cat internalTemperature
@@ -405,30 +1474,55 @@ LJFuse README.txt: Modbus level
   
     http://labjack.com/support/modbus
   
-  Briefly, here are Modbus addresses LJFuse uses:
+  There is a file for every address in the device's register map:
   
     Modbus address        Action
     --------------        -------------------------
-    0                     Read AIN0
-    2                     Read AIN1
-    4                     Read AIN2
-    6                     Read AIN3
+    0, 2, 4, ...          Read AIN0, AIN1, AIN2, ... (AIN0-AIN15 and
+                          AIN30-AIN31 on a U3, AIN0-AIN143 on a U6,
+                          AIN0-AIN13 and AIN128-AIN143 on a UE9)
     5000                  Read/Write DAC0
     5002                  Read/Write DAC1
     6000                  Read/Write FIO0 state
     6001                  Read/Write FIO1 state
     ...                   ...
-    6007                  Read/Write FIO7 state
+    6019 (6022 on U6/UE9) Read/Write state of the last digital IO
     6100                  Read/Write FIO0 direction
-    6101                  Read/Write FIO1 direction
     ...                   ...
-    6107                  Read/Write FIO7 direction
+    6119 (6122 on U6/UE9) Read/Write direction of the last digital IO
+    7000, 7002, ...       Read/Write Timer0, Timer1, ...
+    7200, 7202            Read/Write Counter0, Counter1
+
+  Analog inputs and DACs are 32-bit floats, timers and counters 32-bit
+  integers, and digital IO one 16-bit register. LJFuse reads adjacent
+  addresses of any of these types together when it can.
 
   In the 6000 range, 0 means low and 1 means high. In the 6100 range,
   0 means input and 1 means output.
   
   The file permissions on each file denote which Modbus addresses are
   read-only and which ones allow writes.
+
+  For any other address, such as timer and counter configuration or the
+  50000 range, create its file first. It is read and written with the
+  driver's default width and type for that address.
+
+    $ touch 50590
+
+  The batch file carries out many reads and writes at once. Write lines of
+  `address=value' to write and `address?' to read. They are carried out in
+  order, with no other I/O to the device in between, when the file is
+  next read or closed. Every write is sent, even to an address written
+  just before. Writes on consecutive lines to adjacent addresses take one
+  transaction, and so do consecutive reads of adjacent addresses.
+  Reading the file back through the same open file gives one
+  `address=value' line per `address?'.
+
+    $ printf '5000=2.5\n6100=1\n6000=1\n0?\n2?\n' > batch
+    $ exec 3<>batch; printf '0?\n2?\n5000?\n' >&3; cat <&3; exec 3>&-
+    0=2.501
+    2=0.012
+    5000=2.500
   
   In the example below, wire a jumper from DAC0 to AIN0, and connect an
   LED on FIO2 and GND.
@@ -462,6 +1556,10 @@ LJFuse README.txt: Connection level
   LabJack device. Check the file permissions to see which ones are 
   read-only (e.g., AIN0) and which ones are read-write (e.g., FIO4).
 
+  A program that samples a connection often can keep the file open and
+  read it again from offset 0 (e.g., with pread()) to get a new value
+  each time.
+
   In the example below, wire a jumper from DAC0 to AIN0, and connect an
   LED on FIO2 and GND.
   
@@ -494,6 +1592,25 @@ LJFuse README.txt: Connection level
     FIO6-dir:1    
     FIO7-dir:1    
 
+  The FIO, EIO and CIO files hold a whole port at once, bit 0 for the
+  first line (e.g., FIO0), and are read or written in one command. The
+  -dir files hold the port's directions, 1 for output. Values can be
+  written in decimal or as 0x... hex. Writing states only changes lines
+  that are outputs.
+  Example:
+    $ echo 0xff > FIO-dir # FIO0-FIO7 to digital output
+    $ echo 0x55 > FIO # FIO0, FIO2, FIO4 and FIO6 high, the others low
+    $ cat FIO
+    85   
+
+  On a U6 or UE9, the AIN file holds every analog input, AIN0-AIN13,
+  one per line, all read in one command.
+  Example:
+    $ head -3 AIN
+    AIN0    0.461
+    AIN1    0.012
+    AIN2   -0.003
+
   U3 Note: The U3-LV has flexible inputs FIO0-FIO7, and the U3-HV has
   flexible inputs FIO4-FIO7. Here's how to set them to digital input (0),
   digital output (1), or analog input (2):
@@ -520,7 +1637,1226 @@ LJFuse README.txt: Connection level
 
 """
 
+STREAM_LEVEL_README = """
+LJFuse README.txt: Stream level
+===============================
+
+  At this level, LJFuse streams analog inputs using the device's stream
+  mode, which samples far faster than reading files in connection/.
+  Write a comma-separated list of AIN channel numbers and a scan rate in
+  Hz to the control file to start streaming, and "stop" to stop. Reading
+  control shows the stream's status.
+
+  The data file has one line per scan with one value (in volts) per
+  channel, in the order the channels were given. Read it sequentially;
+  each read returns the scans that arrived since the last one and waits
+  for more while the stream is running. LJFuse buffers up to %d scans.
+  If a reader falls behind, the oldest scans are dropped and counted in
+  control.
+
+  Example:
+    $ echo "0,1 1000" > control # Stream AIN0 and AIN1 at 1000 scans/s
+    $ head -3 data
+    1.234567,0.012345
+    1.234612,0.012298
+    1.234590,0.012331
+    $ echo stop > control
+""" % STREAM_BUFFER_SCANS
+
+HISTORY_LEVEL_README = """
+LJFuse README.txt: History level
+================================
+
+  At this level, LJFuse keeps the most recent values read from each
+  connection, whether read through a file or by a background scan (see
+  --scan-rate). Start LJFuse with --history-depth to choose how many
+  samples to keep; the default is %d. Reading these files doesn't touch
+  the device.
+
+  <label>.csv has a header line, then one "timestamp,value" line per
+  sample, oldest first. <label>.bin has the same samples as pairs of
+  little-endian float64 (timestamp, value), 16 bytes per sample.
+
+  Example:
+    $ cat ../connection/AIN0 > /dev/null
+    $ cat AIN0.csv
+    timestamp,AIN0
+    1286312345.123456,1.234
+    $ python -c "import numpy; print numpy.fromfile('AIN0.bin', '<f8').reshape(-1, 2)"
+""" % HISTORY_SETTINGS["depth"]
+
+
+
+class ReadCache(object):
+    """
+    Recently read register values for one device, kept for the number of
+    seconds CACHE_TTLS gives their class. Every invalidation bumps a
+    generation number, and values read before the latest invalidation are
+    not stored, so a read racing a write can't cache the old value.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.generation = 0
+        self.hits = dict()
+        self.misses = dict()
+
+    def get(self, addr, cacheClass):
+        """Returns (hit, value)"""
+        ttl = CACHE_TTLS.get(cacheClass, 0)
+        self.lock.acquire()
+        try:
+            entry = self.values.get(addr)
+            if ttl > 0 and entry is not None and time() - entry[0] <= ttl:
+                self.hits[cacheClass] = self.hits.get(cacheClass, 0) + 1
+                return True, entry[1]
+            self.misses[cacheClass] = self.misses.get(cacheClass, 0) + 1
+            return False, None
+        finally:
+            self.lock.release()
+
+    def put(self, addr, cacheClass, value, generation, readTime):
+        if CACHE_TTLS.get(cacheClass, 0) <= 0:
+            return
+        self.lock.acquire()
+        try:
+            if generation == self.generation:
+                self.values[addr] = (readTime, value)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, addr = None):
+        """Drop one address, or everything when addr is None"""
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if addr is None:
+                self.values.clear()
+            else:
+                self.values.pop(addr, None)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            result = []
+            for cacheClass in sorted(set(self.hits.keys() + self.misses.keys())):
+                result.append(("cacheHits." + cacheClass, self.hits.get(cacheClass, 0)))
+                result.append(("cacheMisses." + cacheClass, self.misses.get(cacheClass, 0)))
+            return result
+        finally:
+            self.lock.release()
+
+class RingBuffer(object):
+    """
+    The last `depth' (timestamp, value) samples of one channel, held in
+    preallocated arrays so appending never allocates.
+    """
+    def __init__(self, depth):
+        self.depth = depth
+        self.times = array('d', [0.0]) * depth
+        self.values = array('d', [0.0]) * depth
+        self.count = 0 # Samples ever appended
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.depth)
+
+    def append(self, timestamp, value):
+        self.lock.acquire()
+        try:
+            i = self.count % self.depth
+            self.times[i] = timestamp
+            self.values[i] = value
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def ordered(self):
+        """Returns copies of (times, values), oldest sample first"""
+        self.lock.acquire()
+        try:
+            if self.count <= self.depth:
+                return self.times[:self.count], self.values[:self.count]
+            i = self.count % self.depth
+            return self.times[i:] + self.times[:i], self.values[i:] + self.values[:i]
+        finally:
+            self.lock.release()
+
+    def latest(self):
+        """Returns (timestamp, value) of the newest sample, or None"""
+        if self.count == 0:
+            return None
+        i = (self.count - 1) % self.depth
+        return self.times[i], self.values[i]
+
+def scanAddresses(device):
+    """Modbus addresses of every connection label on a device"""
+    if device.devType == 3:
+        if device.deviceName == "U3-HV":
+            labels = U3_HV_CONNECTION_LABELS
+            flexibleLabels = U3_HV_FLEXIBLE_CONNECTION_LABELS
+        else:
+            labels = U3_LV_CONNECTION_LABELS
+            flexibleLabels = U3_LV_FLEXIBLE_CONNECTION_LABELS
+        # Flexible IO is scanned as digital. Lines set to analog input
+        # aren't scanned and are read from the device as before.
+        addrs = [6000 + ioNumber for ioNumber in flexibleLabels.values()]
+    else:
+        labels = CONNECTION_LABELS[device.devType]
+        addrs = []
+    addrs += [addr for addr, mode in labels.values()]
+    addrs.append(TEMPERATURE_ADDRS[device.devType])
+    return sorted(addrs)
+
+class Scanner(object):
+    """
+    Reads a fixed list of addresses from a device `rate' times a second in
+    as few multi-register reads as possible, and records the samples in
+    the dispatcher's history. While the scanner is running, reads of those
+    addresses are answered from the latest sample without device I/O.
+    """
+    def __init__(self, dispatcher, addrs, rate):
+        self.dispatcher = dispatcher
+        self.addrs = addrs
+        self.rate = rate
+        self.dispatcher.trackHistory(addrs)
+        self.notBefore = dict()
+        self.thread = None
+        self.running = False
+        self.scanCount = 0
+        self.errorCount = 0
+        self.startTime = time()
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.startTime = time()
+            self.thread = threading.Thread(target=self._run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        period = 1.0 / self.rate
+        nextScan = time()
+        while self.running:
+            # Stamp samples with the time the scan was queued, so a write
+            # queued after it (see invalidate) marks them stale.
+            scanTime = time()
+            try:
+                self.dispatcher.readRegisters(self.addrs, scanTime)
+                self.scanCount += 1
+            except Exception, e:
+                if DEBUG: print "Scanner error:", e
+                self.errorCount += 1
+            nextScan += period
+            delay = nextScan - time()
+            if delay > 0:
+                sleep(delay)
+            else:
+                # Fell behind; don't try to catch up
+                nextScan = time()
+
+    def latest(self, addr):
+        """The newest usable sample of addr, or None"""
+        buf = self.dispatcher.history.get(addr)
+        if buf is None:
+            return None
+        sample = buf.latest()
+        if sample is None:
+            return None
+        timestamp, value = sample
+        if timestamp <= self.notBefore.get(addr, 0):
+            return None
+        if time() - timestamp > STALE_SCANS / self.rate:
+            return None
+        if registerFormat(self.dispatcher.device.devType, addr) in ('H', 'I'):
+            return int(value)
+        return value
+
+    def invalidate(self, addr = None):
+        """Ignore samples of addr (or every address) taken before now"""
+        now = time()
+        if addr is None:
+            for addr in self.addrs:
+                self.notBefore[addr] = now
+        else:
+            self.notBefore[addr] = now
+
+    def stats(self):
+        elapsed = max(time() - self.startTime, 1e-9)
+        return [("scans", self.scanCount),
+                ("scanErrors", self.errorCount),
+                ("scansPerSecond", "%0.3f" % (self.scanCount / elapsed))]
+
+def streamConfigure(device, channels, rate):
+    """Configures stream mode on a U3, U6 or UE9 for single-ended AINs"""
+    numChannels = len(channels)
+    if device.devType == 3:
+        device.streamConfig(NumChannels = numChannels, PChannels = channels,
+            NChannels = [31] * numChannels, Resolution = 3, ScanFrequency = rate)
+    elif device.devType == 6:
+        device.streamConfig(NumChannels = numChannels, ChannelNumbers = channels,
+            ChannelOptions = [0] * numChannels, ResolutionIndex = 1, ScanFrequency = rate)
+    else:
+        device.streamConfig(NumChannels = numChannels, ChannelNumbers = channels,
+            ChannelOptions = [0] * numChannels, Resolution = 12, ScanFrequency = rate)
+
+class Streamer(object):
+    """
+    Runs stream mode on one device. A thread reads converted samples from
+    streamData() into a bounded buffer of text lines, one per scan, which
+    stream/data hands out to a sequential reader. When the buffer is full
+    the oldest scans are dropped and counted.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.condition = threading.Condition()
+        self.buffer = deque()
+        self.thread = None
+        self.running = False
+        self.channels = []
+        self.rate = 0
+        self.error = None
+        self.scanCount = 0
+        self.droppedCount = 0
+        self.missedCount = 0
+
+    def start(self, channels, rate):
+        self.stop()
+        # Configuring and starting go through the dispatcher like any other
+        # command. Stream data arrives on its own endpoint, so the reader
+        # thread calls streamData() directly.
+        self.device.dispatcher.call(streamConfigure, self.device, channels, rate)
+        self.device.dispatcher.call(self.device.streamStart)
+        self.condition.acquire()
+        try:
+            self.buffer.clear()
+            self.channels = channels
+            self.rate = rate
+            self.error = None
+            self.scanCount = self.droppedCount = self.missedCount = 0
+            self.running = True
+        finally:
+            self.condition.release()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running = False
+        try:
+            self.device.dispatcher.call(self.device.streamStop)
+        except Exception, e:
+            if DEBUG: print "Streamer streamStop failed:", e
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        try:
+            for result in self.device.streamData():
+                if not self.running:
+                    break
+                if result is None:
+                    continue
+                columns = [result["AIN%d" % c] for c in self.channels]
+                lines = [','.join(['%0.6f' % v for v in scan]) + '\n' for scan in zip(*columns)]
+                self.condition.acquire()
+                try:
+                    self.missedCount += result['missed']
+                    self.scanCount += len(lines)
+                    self.buffer.extend(lines)
+                    while len(self.buffer) > STREAM_BUFFER_SCANS:
+                        self.buffer.popleft()
+                        self.droppedCount += 1
+                    self.condition.notifyAll()
+                finally:
+                    self.condition.release()
+        except Exception, e:
+            if self.running:
+                if DEBUG: print "Streamer error:", e
+                self.error = e
+        self.condition.acquire()
+        self.running = False
+        self.condition.notifyAll()
+        self.condition.release()
+
+    def read(self, size):
+        """
+        Returns up to size bytes of buffered scans, waiting for some if the
+        stream is running. Returns '' once the stream has stopped and the
+        buffer is empty.
+        """
+        self.condition.acquire()
+        try:
+            while not self.buffer and self.running:
+                self.condition.wait(1.0)
+            data = []
+            length = 0
+            while self.buffer and length + len(self.buffer[0]) <= size:
+                line = self.buffer.popleft()
+                data.append(line)
+                length += len(line)
+            if not data and self.buffer:
+                # A line longer than size; hand it out in pieces
+                line = self.buffer.popleft()
+                data.append(line[:size])
+                self.buffer.appendleft(line[size:])
+            return ''.join(data)
+        finally:
+            self.condition.release()
+
+    def status(self):
+        self.condition.acquire()
+        try:
+            if self.running:
+                state = "running"
+            else:
+                state = "stopped"
+            lines = ["state %s" % state,
+                     "channels %s" % ','.join([str(c) for c in self.channels]),
+                     "rate %s" % self.rate,
+                     "scans %d" % self.scanCount,
+                     "buffered %d" % len(self.buffer),
+                     "dropped %d" % self.droppedCount,
+                     "missed %d" % self.missedCount]
+            if self.error is not None:
+                lines.append("error %s" % self.error)
+            return '\n'.join(lines) + '\n'
+        finally:
+            self.condition.release()
+
+class IORequest(object):
+    """
+    One unit of work queued on a DeviceDispatcher. The worker thread runs
+    it, and every thread waiting on it gets the same result or exception.
+    """
+    def __init__(self, func, args, key = None, transactions = 1):
+        self.func = func
+        self.args = args
+        self.key = key
+        self.transactions = transactions
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            self.error = e
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+# LabJackException.errorCode for a Modbus response of the wrong length,
+# which is what a read gets once LJSocket has closed the connection
+MODBUS_SHORT_RESPONSE = 9001
+
+def isDisconnect(e):
+    """True for an error that means an LJSocket connection is gone"""
+    if isinstance(e, socket.error):
+        return True
+    return (isinstance(e, LabJackPython.LabJackException) and
+            getattr(e, "errorCode", None) == MODBUS_SHORT_RESPONSE)
+
+class LJSocketConnection(object):
+    """
+    One LJSocket connection to a device, for Modbus reads. If the
+    connection drops, it is reopened and the read tried once more.
+    """
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self.opened = conn is pool.device
+
+    def readRegister(self, *args, **kwargs):
+        if not self.opened:
+            self.reopen()
+        try:
+            return self.conn.readRegister(*args, **kwargs)
+        except Exception, e:
+            if not isDisconnect(e):
+                raise
+            if DEBUG: print "LJSocketConnection reconnecting after:", e
+            self.reopen()
+            return self.conn.readRegister(*args, **kwargs)
+
+    def reopen(self):
+        if self.opened:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.pool.lock.acquire()
+            self.pool.reconnectCount += 1
+            self.pool.lock.release()
+        self.opened = False
+        # A handle is all a Modbus read needs, so skip reading the config
+        self.conn.open(firstFound = False, serial = self.pool.device.serialNumber,
+            handleOnly = True, LJSocket = self.pool.ljsocketAddress)
+        self.opened = True
+
+    def close(self):
+        if self.opened:
+            self.conn.close()
+            self.opened = False
+
+class ConnectionPool(object):
+    """
+    The LJSocket connections to one device: the device's own, plus
+    size - 1 more opened on first use. LJSocket answers the requests on
+    one connection strictly in turn, so each transaction costs a network
+    round trip. Independent reads handed to map() run on all connections at
+    once. Everything else stays on the device's own connection, in order.
+    """
+    def __init__(self, device, ljsocketAddress, size):
+        self.device = device
+        self.ljsocketAddress = ljsocketAddress
+        self.connections = [LJSocketConnection(self, device)]
+        for i in range(size - 1):
+            self.connections.append(LJSocketConnection(self, type(device)(autoOpen = False)))
+        self.jobs = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.reconnectCount = 0
+
+    def _start(self):
+        # Started on first use, like DeviceDispatcher's worker thread
+        if not self.threads:
+            for connection in self.connections[1:]:
+                thread = threading.Thread(target=self._work, args=(connection, True))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self, connection, block):
+        while True:
+            try:
+                job = self.jobs.get(block)
+            except Queue.Empty:
+                return
+            if job is None:
+                return
+            func, item, results, i, done = job
+            try:
+                results[i] = func(connection, item)
+            finally:
+                done.set()
+
+    def map(self, func, items):
+        """
+        Calls func(connection, item) for every item and returns the results
+        in order. The calling thread works through items on the device's
+        own connection while the pool's threads take others. func must
+        handle its own errors.
+        """
+        self._start()
+        results = [None] * len(items)
+        done = [threading.Event() for item in items]
+        for i, item in enumerate(items):
+            self.jobs.put((func, item, results, i, done[i]))
+        self._work(self.connections[0], False)
+        for event in done:
+            event.wait()
+        return results
+
+    def reopen(self):
+        """Reopens the device's own connection"""
+        self.connections[0].reopen()
+
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for connection in self.connections[1:]:
+            connection.close()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return [("connections", len(self.connections)),
+                    ("reconnects", self.reconnectCount)]
+        finally:
+            self.lock.release()
+
+class WriteCombiner(object):
+    """
+    Holds a device's writes to DACs and digital IO for up to `window'
+    seconds, then queues them on its dispatcher as one request. On a U3 or
+    U6 they go out as feedback packets, so the outputs change together.
+    If a packet fails, every write in it fails, since some of them may
+    already have taken effect. On a UE9 each write is sent on its own.
+    """
+    def __init__(self, dispatcher, window):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.lock = threading.Lock()
+        self.held = []
+        self.timer = None
+        self.writeCount = 0
+        self.packetCount = 0
+        self.errorCount = 0
+        # The address and error of the last write that failed. Its file
+        # may have been closed before it was sent, so this is the only
+        # place that failure shows.
+        self.lastError = None
+
+    def accepts(self, addr):
+        # IO 20-22 are MIO0-2, which a U3 doesn't have
+        if self.dispatcher.device.devType == 3:
+            lines = 20
+        else:
+            lines = 23
+        return addr in (5000, 5002) or 6000 <= addr < 6000 + lines or 6100 <= addr < 6100 + lines
+
+    def add(self, addr, value):
+        """Holds a write and returns its IORequest, which is done once sent"""
+        write = IORequest(self.dispatcher.device.writeRegister, (addr, value))
+        self.lock.acquire()
+        try:
+            self.held.append(write)
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.setDaemon(True)
+                self.timer.start()
+        finally:
+            self.lock.release()
+        return write
+
+    def flush(self):
+        """Queues the held writes on the dispatcher without waiting"""
+        self.lock.acquire()
+        try:
+            writes = self.held
+            self.held = []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+        if writes:
+            self.dispatcher._queue(IORequest(self.send, (writes,), transactions = 0))
+
+    def feedbackCommands(self, driver, addr, value):
+        device = self.dispatcher.device
+        if addr in (5000, 5002):
+            dac = (addr - 5000) / 2
+            return [driver.DAC16(dac, device.voltageToDACBits(value, dac, True))]
+        elif addr >= 6100:
+            return [driver.BitDirWrite(addr - 6100, int(value))]
+        else:
+            # Like a Modbus write to the state register, make it an output
+            return [driver.BitDirWrite(addr - 6000, 1), driver.BitStateWrite(addr - 6000, int(value))]
+
+    def send(self, writes):
+        # Runs on the dispatcher's worker thread
+        device = self.dispatcher.device
+        self.writeCount += len(writes)
+        driver = feedbackDriver(device)
+        for i in range(0, len(writes), MAX_FEEDBACK_WRITES):
+            chunk = writes[i:i + MAX_FEEDBACK_WRITES]
+            if driver is not None:
+                self.dispatcher.countTransactions(1)
+                try:
+                    commands = []
+                    for write in chunk:
+                        commands += self.feedbackCommands(driver, *write.args)
+                    device.getFeedback(*commands)
+                    self.packetCount += 1
+                except Exception, e:
+                    # Don't resend any of them; part of the packet may
+                    # have been carried out
+                    if DEBUG: print "WriteCombiner feedback packet failed:", e
+                    self.errorCount += len(chunk)
+                    self.lastError = "%d: %s" % (chunk[0].args[0], e)
+                    for write in chunk:
+                        write.error = e
+                for write in chunk:
+                    write.done.set()
+                continue
+            for write in chunk:
+                self.dispatcher.countTransactions(1)
+                write.run()
+                if write.error is not None:
+                    self.errorCount += 1
+                    self.lastError = "%d: %s" % (write.args[0], write.error)
+
+    def stats(self):
+        return [("heldWrites", self.writeCount),
+                ("writePackets", self.packetCount),
+                ("writeErrors", self.errorCount),
+                ("lastWriteError", self.lastError or "none")]
+
+class DeviceDispatcher(object):
+    """
+    Serializes all I/O to one device through a single worker thread.
+
+    FUSE calls into LJFuse from several threads at once, but a device
+    handle can only carry one transaction at a time. Reads of a register
+    that is already waiting in the queue are merged into that request, so
+    N readers polling the same file cost one round trip.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pendingReads = dict()
+        self.thread = None
+        self.cache = ReadCache()
+        self.scanner = None
+        # ConnectionPool for devices opened through LJSocket
+        self.pool = None
+        # WriteCombiner, when writes are held (see WRITE_SETTINGS)
+        self.combiner = None
+        # RingBuffer of recent samples by address, for the addresses
+        # passed to trackHistory()
+        self.history = dict()
+
+        self.startTime = time()
+        self.requestCount = 0
+        self.transactionCount = 0
+        self.coalescedCount = 0
+        self.batchedCount = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def _start(self):
+        # Started on first use rather than in __init__ so the thread
+        # belongs to the process left running after FUSE daemonizes.
+        # Nothing may use the dispatcher before then.
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        held = []
+        while True:
+            if held:
+                request = held.pop()
+            else:
+                request = self.queue.get()
+            if request is None:
+                break
+            if request.key is None:
+                self._forget([request])
+                self.lock.acquire()
+                self.transactionCount += request.transactions
+                self.lock.release()
+                request.run()
+                if self.pool is not None and isDisconnect(request.error):
+                    # Don't resend it, since it may have reached the device
+                    try:
+                        self.pool.reopen()
+                    except Exception, e:
+                        if DEBUG: print "DeviceDispatcher can't reconnect:", e
+                continue
+
+            # Gather every read already queued, plus any arriving within the
+            # batch window, up to the next request that isn't a read.
+            reads = [request]
+            deadline = time() + BATCH_SETTINGS["window"]
+            while True:
+                try:
+                    timeout = deadline - time()
+                    if timeout > 0:
+                        nextRequest = self.queue.get(True, timeout)
+                    else:
+                        nextRequest = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if nextRequest is None or nextRequest.key is None:
+                    held.append(nextRequest)
+                    break
+                reads.append(nextRequest)
+
+            self._forget(reads)
+            byAddr = dict()
+            for read in reads:
+                byAddr.setdefault(read.key, []).append(read)
+            self._map(lambda conn, run: self._runBatch(conn, run, byAddr), contiguousRuns(self.device.devType, byAddr.keys()))
+
+    def _map(self, func, items):
+        """func(conn, item) for each item, spread over the pool if there is one"""
+        if self.pool is not None:
+            return self.pool.map(func, items)
+        return [func(self.device, item) for item in items]
+
+    def _forget(self, requests):
+        self.lock.acquire()
+        try:
+            for request in requests:
+                if self.pendingReads.get(request.key) is request:
+                    del self.pendingReads[request.key]
+        finally:
+            self.lock.release()
+
+    def _runBatch(self, conn, run, byAddr):
+        """
+        Reads a run of contiguous addresses through conn and hands each
+        value to the requests for that address in byAddr.
+        """
+        self.lock.acquire()
+        self.transactionCount += 1
+        if len(run) > 1:
+            self.batchedCount += len(run)
+        self.lock.release()
+
+        if len(run) == 1:
+            result, error = None, None
+            try:
+                result = readRun(conn, self.device.devType, run)[0]
+            except Exception, e:
+                error = e
+            for request in byAddr[run[0]]:
+                request.result, request.error = result, error
+                request.done.set()
+            return
+
+        try:
+            values = readRun(conn, self.device.devType, run)
+        except Exception, e:
+            if DEBUG: print "DeviceDispatcher batch read failed, reading singly:", e
+            for addr in run:
+                self._runBatch(conn, [addr], byAddr)
+            return
+        for addr, value in zip(run, values):
+            for request in byAddr[addr]:
+                request.result = value
+                request.done.set()
+
+    def _readBlock(self, addrs):
+        # Runs on the worker thread for readRegisters()
+        values = dict()
+        for runValues in self._map(self._readRunValues, contiguousRuns(self.device.devType, addrs)):
+            values.update(runValues)
+        return values
+
+    def _readRunValues(self, conn, run):
+        """The values of a run of addresses that could be read, by address"""
+        self.lock.acquire()
+        self.transactionCount += 1
+        self.lock.release()
+        values = dict()
+        try:
+            values.update(zip(run, readRun(conn, self.device.devType, run)))
+        except Exception, e:
+            if DEBUG: print "DeviceDispatcher block read failed, reading singly:", e
+            for addr in run:
+                self.lock.acquire()
+                self.transactionCount += 1
+                self.lock.release()
+                try:
+                    values[addr] = readRun(conn, self.device.devType, [addr])[0]
+                except Exception, e:
+                    if DEBUG: print "DeviceDispatcher can't read addr", addr, e
+        return values
+
+    def countTransactions(self, count):
+        self.lock.acquire()
+        self.transactionCount += count
+        self.lock.release()
+
+    def _queue(self, request):
+        """Queues a request that may change device state, without waiting"""
+        self.lock.acquire()
+        try:
+            self._start()
+            self.pendingReads.clear()
+            self.queue.put(request)
+        finally:
+            self.lock.release()
+
+    def _submit(self, request):
+        # Held writes go first, so this request sees their effect
+        if self.combiner is not None:
+            self.combiner.flush()
+        start = time()
+        self.lock.acquire()
+        try:
+            self._start()
+            self.requestCount += 1
+            if request.key is not None:
+                pending = self.pendingReads.get(request.key)
+                if pending is not None:
+                    self.coalescedCount += 1
+                    request = pending
+                else:
+                    self.pendingReads[request.key] = request
+                    self.queue.put(request)
+            else:
+                # Anything but a read may change device state, so later
+                # reads must not be merged with ones queued before it.
+                self.pendingReads.clear()
+                self.queue.put(request)
+        finally:
+            self.lock.release()
+
+        try:
+            return request.wait()
+        finally:
+            latency = time() - start
+            self.lock.acquire()
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+            self.lock.release()
+
+    def readRegister(self, addr, cacheClass = None):
+        if cacheClass is None:
+            cacheClass = registerClass(addr)
+        if self.scanner is not None:
+            value = self.scanner.latest(addr)
+            if value is not None:
+                return value
+        hit, value = self.cache.get(addr, cacheClass)
+        if hit:
+            return value
+        generation = self.cache.generation
+        readTime = time()
+        value = self._submit(IORequest(self.device.readRegister, (addr,), key = addr))
+        self.cache.put(addr, cacheClass, value, generation, readTime)
+        self.recordSample(addr, readTime, value)
+        return value
+
+    def readRegisters(self, addrs, readTime = None):
+        """
+        Reads several addresses with as few multi-register reads as
+        possible, bypassing the cache. Returns a dict of addr to value;
+        addresses that can't be read are left out. The values are recorded
+        in the history as of readTime, which defaults to now.
+        """
+        if readTime is None:
+            readTime = time()
+        values = self._submit(IORequest(self._readBlock, (addrs,), transactions = 0))
+        for addr, value in values.items():
+            self.recordSample(addr, readTime, value)
+        return values
+
+    def trackHistory(self, addrs):
+        """Start keeping a history of the values read from addrs"""
+        for addr in addrs:
+            if addr not in self.history:
+                self.history[addr] = RingBuffer(HISTORY_SETTINGS["depth"])
+
+    def recordSample(self, addr, timestamp, value):
+        buf = self.history.get(addr)
+        if buf is not None:
+            buf.append(timestamp, value)
+
+    def invalidate(self, addr = None):
+        self.cache.invalidate(addr)
+        if self.scanner is not None:
+            self.scanner.invalidate(addr)
+
+    def writeRegister(self, addr, value):
+        """
+        Writes a register. A write the combiner holds returns its IORequest
+        at once; wait() on it for the result.
+        """
+        self.invalidate(addr)
+        if self.combiner is not None and self.combiner.accepts(addr):
+            return self.combiner.add(addr, value)
+        return self._submit(IORequest(self.device.writeRegister, (addr, value)))
+
+    def transact(self, operations):
+        """
+        Carries out a list of ('write', addr, value) and ('read', addr)
+        operations as one request, so no other I/O to the device comes
+        between them. Writes go out in order; consecutive writes to
+        adjacent addresses share a multi-register transaction. Each stretch
+        of consecutive reads takes as few transactions as possible. Returns
+        the values read, in order.
+        """
+        self.invalidate()
+        return self._submit(IORequest(self._transact, (operations,), transactions = 0))
+
+    def _transact(self, operations):
+        # Runs on the worker thread for transact()
+        values = []
+        start = 0
+        while start < len(operations):
+            kind = operations[start][0]
+            end = start
+            while end < len(operations) and operations[end][0] == kind:
+                end += 1
+            stretch = operations[start:end]
+            start = end
+
+            if kind == 'write':
+                # Order matters (a direction before a state, a pulse of
+                # several writes to one line), so each write joins the run
+                # before it only if it's the next address of the same type
+                run = []
+                for op, addr, value in stretch:
+                    format = registerFormat(self.device.devType, addr)
+                    if format == 'f':
+                        value = float(value)
+                    elif format is not None:
+                        value = int(value)
+                    if run and not self._continuesRun(run, addr):
+                        self._writeRun(run)
+                        run = []
+                    run.append((addr, value))
+                if run:
+                    self._writeRun(run)
+            else:
+                readTime = time()
+                read = self._readBlock([addr for op, addr in stretch])
+                for op, addr in stretch:
+                    if addr not in read:
+                        raise IOError("Can't read address %d" % addr)
+                    self.recordSample(addr, readTime, read[addr])
+                    values.append(read[addr])
+        return values
+
+    def _continuesRun(self, run, addr):
+        """
+        True if a write to addr can go in the same multi-register write as
+        run, a list of (addr, value) of contiguous addresses of one type.
+        A multi-register write takes the type of its first address.
+        """
+        last = registerInfo(self.device.devType, run[-1][0])
+        info = registerInfo(self.device.devType, addr)
+        if last is None or info is None:
+            return False
+        numReg = sum(registerInfo(self.device.devType, a)[1] for a, v in run)
+        return addr == run[-1][0] + last[1] and info[0] == last[0] \
+            and numReg + info[1] <= MAX_BATCH_REGISTERS
+
+    def _writeRun(self, run):
+        """Writes a run of (addr, value) from _continuesRun() in one transaction"""
+        self.countTransactions(1)
+        if len(run) == 1:
+            self.device.writeRegister(run[0][0], run[0][1])
+            return
+        try:
+            self.device.writeRegister(run[0][0], registerWords(self.device.devType, run))
+        except LabJackPython.LabJackException, e:
+            if DEBUG: print "DeviceDispatcher multi-register write failed, writing singly:", e
+            for write in run:
+                self._writeRun([write])
+
+    def getFeedback(self, *commands):
+        self.invalidate()
+        return self._submit(IORequest(self.device.getFeedback, commands))
+
+    def query(self, func, *args):
+        """Like call(), for device methods that only read, so cached values are kept"""
+        return self._submit(IORequest(func, args))
+
+    def call(self, func, *args):
+        """Run any other device method on the worker thread."""
+        self.invalidate()
+        return self._submit(IORequest(func, args))
+
+    def ping(self):
+        """Raises if the device no longer answers a register read"""
+        addr = TEMPERATURE_ADDRS[self.device.devType]
+        self._submit(IORequest(self.device.readRegister, (addr,), key = addr))
+
+    def close(self):
+        if self.scanner is not None:
+            self.scanner.stop()
+        if self.combiner is not None:
+            self.combiner.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.pool is not None:
+            self.pool.close()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            elapsed = max(time() - self.startTime, 1e-9)
+            if self.requestCount:
+                meanLatency = self.totalLatency / self.requestCount
+            else:
+                meanLatency = 0.0
+            result = [("requests", self.requestCount),
+                      ("transactions", self.transactionCount),
+                      ("coalesced", self.coalescedCount),
+                      ("batched", self.batchedCount),
+                      ("queueDepth", self.queue.qsize()),
+                      ("transactionsPerSecond", "%0.3f" % (self.transactionCount / elapsed)),
+                      ("meanLatencyMs", "%0.3f" % (meanLatency * 1000)),
+                      ("maxLatencyMs", "%0.3f" % (self.maxLatency * 1000))] + self.cache.stats()
+        finally:
+            self.lock.release()
+        if self.scanner is not None:
+            result += self.scanner.stats()
+        if self.pool is not None:
+            result += self.pool.stats()
+        if self.combiner is not None:
+            result += self.combiner.stats()
+        return result
+
+class CalibrationCache(object):
+    """
+    Calibration constants of U3s and U6s saved on disk by serial number,
+    so startup doesn't read every device's calibration flash again. An
+    entry is used only while the device reports the same type and firmware
+    version it had when the entry was saved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.changed = False
+        if not self.path:
+            return
+        try:
+            f = open(self.path, 'rb')
+            try:
+                self.entries = pickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            if DEBUG: print "Not using calibration cache %s: %s" % (self.path, e)
+
+    def getCalibrationData(self, d):
+        """
+        Sets d's calibration constants from the cache if possible, otherwise
+        reads them from d and adds them to the cache.
+        """
+        if not self.path:
+            d.getCalibrationData()
+            return
+        serial = str(d.serialNumber)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(serial)
+        finally:
+            self.lock.release()
+
+        if entry is not None and not CALIBRATION_SETTINGS["refresh"] \
+                and entry["devType"] == d.devType \
+                and entry["firmwareVersion"] == d.firmwareVersion:
+            if d.devType == 3:
+                d.calData = dict(entry["calibration"])
+            else:
+                d.calInfo.__dict__.update(entry["calibration"])
+            return
 
+        d.getCalibrationData()
+        if d.devType == 3:
+            calibration = dict(d.calData)
+        else:
+            calibration = dict(d.calInfo.__dict__)
+        entry = { "devType" : d.devType, "firmwareVersion" : d.firmwareVersion,
+                  "calibration" : calibration }
+        self.lock.acquire()
+        try:
+            self.entries[serial] = entry
+            self.changed = True
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """Writes the cache back to disk if any entry changed."""
+        if not self.path or not self.changed:
+            return
+        tmpPath = self.path + ".tmp"
+        try:
+            f = open(tmpPath, 'wb')
+            try:
+                pickle.dump(self.entries, f, 2)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+            self.changed = False
+        except (IOError, OSError), e:
+            print "Couldn't save calibration cache %s: %s" % (self.path, e)
+
+def openDevice(dev, ljsocketAddress, calibrationCache):
+    """
+    Opens and configures the device described by a listAll entry, taking
+    calibration constants from calibrationCache. Returns None for device
+    types LJFuse doesn't show.
+    """
+    if dev['prodId'] == 3:
+        if DEBUG: print "Adding new device with serial = %s" % (dev['serial'])
+        import u3
+        try:
+            d = u3.U3(LJSocket = ljsocketAddress, serial = dev['serial'])
+        except Exception, e:
+            raise Exception( "Error opening U3: %s" % e )
+
+        try:
+            d.configU3()
+            calibrationCache.getCalibrationData(d)
+        except Exception, e:
+            raise Exception( "Error with configU3: %s" % e )
+
+    elif dev['prodId'] == 6:
+        import u6
+        try:
+            d = u6.U6(LJSocket = ljsocketAddress, serial = dev['serial'])
+            d.configU6()
+            calibrationCache.getCalibrationData(d)
+        except Exception, e:
+            raise Exception( "Error opening U6: %s" % e )
+
+    elif dev['prodId'] == 9:
+        import ue9
+        d = ue9.UE9(LJSocket = ljsocketAddress, serial = dev['serial'])
+        d.commConfig()
+        d.controlConfig()
+
+    elif dev['prodId'] == 0x501:
+        return None
+    else:
+        raise Exception("Unknown device type")
+
+    return d
+
+def openDevices(devs, ljsocketAddress, calibrationCache):
+    """
+    Opens devices on up to OPEN_THREADS threads at once, so startup takes
+    about as long as the slowest device rather than all of them together.
+    A device that fails to open is reported and left out; the rest are
+    returned as (listAll entry, device) pairs in the order of devs.
+    """
+    pending = Queue.Queue()
+    for i, dev in enumerate(devs):
+        pending.put((i, dev))
+    opened = [None] * len(devs)
+
+    def work():
+        while True:
+            try:
+                i, dev = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                opened[i] = openDevice(dev, ljsocketAddress, calibrationCache)
+            except Exception, e:
+                print "Couldn't open device with serial %s: %s" % (dev['serial'], e)
+
+    workers = [ threading.Thread(target = work) for i in range(min(OPEN_THREADS, len(devs))) ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return [ (dev, d) for dev, d in zip(devs, opened) if d is not None ]
 
 class DeviceManager(object):
     """
@@ -533,6 +2869,8 @@ class DeviceManager(object):
         self.port = LJSOCKET_PORT
         self.deviceBySerial = dict()
         self.deviceByName = dict()
+        # listAll entries of devices not opened yet, by directory name
+        self.pendingByName = dict()
 
         self.usbOverride = False
 
@@ -552,10 +2890,18 @@ class DeviceManager(object):
 
             devCount = LabJackPython.deviceCount(None)
 
+            # listAll can't open the devices we already have open, so it
+            # leaves them out. Keep those that still answer. Close the
+            # others; if one was unplugged and plugged back in, listAll
+            # finds it again and it's opened as a new device.
             for serial, dev in self.deviceBySerial.items():
-                dev.close()
-                self.deviceBySerial.pop(serial)
-            self.deviceByName = dict()
+                try:
+                    dev.dispatcher.ping()
+                except Exception, e:
+                    if DEBUG: print "Device with serial = %s stopped answering: %s" % (serial, e)
+                    self.closeDevice(serial)
+                    continue
+                devs.append({"serial" : serial, "prodId" : dev.devType})
 
             devsObj = LabJackPython.listAll(3)
             for dev in devsObj.values():
@@ -580,64 +2926,123 @@ class DeviceManager(object):
             devs = LabJackPython.listAll(ljsocketAddress, LabJackPython.LJ_ctLJSOCKET)
 
         serials = list()
+        newDevs = list()
+        pendingSerials = [str(dev['serial']) for dev in self.pendingByName.values()]
 
         for dev in devs:
             serials.append(str(dev['serial']))
 
-            if str(dev['serial']) in self.deviceBySerial:
-                continue
-
-            if dev['prodId'] == 3:
-                if DEBUG: print "Adding new device with serial = %s" % (dev['serial'])
-                try:
-                    d = u3.U3(LJSocket = ljsocketAddress, serial = dev['serial'])
-                except Exception, e:
-                    raise Exception( "Error opening U3: %s" % e )
-
-                try:
-                    d.configU3()
-                    d.getCalibrationData()
-                except Exception, e:
-                    raise Exception( "Error with configU3: %s" % e )
-
-            elif dev['prodId'] == 6:
-                try:
-                    d = u6.U6(LJSocket = ljsocketAddress, serial = dev['serial'])
-                    d.configU6()
-                    d.getCalibrationData()
-                except Exception, e:
-                    if DEBUG: print "In opening a U6: %s" % e
-
-            elif dev['prodId'] == 9:
-                d = ue9.UE9(LJSocket = ljsocketAddress, serial = dev['serial'])
-                d.commConfig()
-                d.controlConfig()
-
-            elif dev['prodId'] == 0x501:
-                continue
-            else:
-                raise Exception("Unknown device type")
+            if str(dev['serial']) not in self.deviceBySerial and str(dev['serial']) not in pendingSerials:
+                newDevs.append(dev)
 
-            self.deviceBySerial["%s" % str(d.serialNumber)] = d
-            self.deviceByName["%s" % str(d.name)] = d
+        if DEVICE_SETTINGS["lazy"]:
+            for dev in newDevs:
+                if dev['prodId'] in PRODUCT_NAMES:
+                    self.pendingByName["%s %s" % (PRODUCT_NAMES[dev['prodId']], dev['serial'])] = dev
+        else:
+            calibrationCache = CalibrationCache(CALIBRATION_SETTINGS["path"])
+            for dev, d in openDevices(newDevs, ljsocketAddress, calibrationCache):
+                # Only listed under the unique name; the device's own name,
+                # stored in its flash, is left alone
+                name = self.uniqueName(str(d.name), d)
+                self.registerDevice(d, name, ljsocketAddress)
+            calibrationCache.save()
+
+        # Forget pending devices that were disconnected before being opened
+        for name, dev in self.pendingByName.items():
+            if str(dev['serial']) not in serials:
+                self.pendingByName.pop(name)
 
         # Remove the disconnected devices
         for serial in self.deviceBySerial.keys():
             if serial not in serials:
                 if DEBUG: print "Removing device with serial = %s" % serial
-                dd = self.deviceBySerial[str(serial)]
-                for name, nd in self.deviceByName.items():
-                    if dd == nd:
-                        self.deviceByName.pop(name)
-                        break
-                dd.close()
-                self.deviceBySerial.pop(str(serial))
+                self.closeDevice(serial)
+
+    def closeDevice(self, serial):
+        """Stops and closes an open device and forgets it"""
+        dd = self.deviceBySerial.pop(str(serial))
+        for name, nd in self.deviceByName.items():
+            if dd == nd:
+                self.deviceByName.pop(name)
+                break
+        dd.streamer.stop()
+        dd.dispatcher.close()
+        try:
+            dd.close()
+        except Exception, e:
+            # Its handle may already be dead
+            if DEBUG: print "Couldn't close device with serial = %s: %s" % (serial, e)
     
+    def registerDevice(self, d, name, ljsocketAddress):
+        """Sets up an opened device's dispatcher and streamer and lists it under name"""
+        d.dispatcher = DeviceDispatcher(d)
+        if ljsocketAddress is not None:
+            d.dispatcher.pool = ConnectionPool(d, ljsocketAddress, LJSOCKET_SETTINGS["connections"])
+        if WRITE_SETTINGS["window"] > 0:
+            d.dispatcher.combiner = WriteCombiner(d.dispatcher, WRITE_SETTINGS["window"])
+        d.streamer = Streamer(d)
+        scanSerials = SCAN_SETTINGS["serials"]
+        if SCAN_SETTINGS["rate"] > 0 and (not scanSerials or str(d.serialNumber) in scanSerials):
+            d.dispatcher.scanner = Scanner(d.dispatcher, scanAddresses(d), SCAN_SETTINGS["rate"])
+        self.deviceBySerial["%s" % str(d.serialNumber)] = d
+        self.deviceByName[name] = d
+
+    def openPending(self, name):
+        """
+        Opens the pending device listed under name and registers it under
+        the device's own name, or under name if it was renamed while
+        pending. Returns the name it's registered under. It stays in
+        pendingByName until the caller has built its directory.
+        """
+        dev = self.pendingByName[name]
+        if self.usbOverride:
+            ljsocketAddress = None
+        else:
+            ljsocketAddress = "%s:%s" % (self.address, self.port)
+        calibrationCache = CalibrationCache(CALIBRATION_SETTINGS["path"])
+        d = openDevice(dev, ljsocketAddress, calibrationCache)
+        calibrationCache.save()
+        if dev.get("renamed"):
+            # Renaming a device's directory renames the device, as it
+            # does for open ones
+            d.name = name
+        else:
+            name = self.uniqueName(str(d.name), d, name)
+        self.registerDevice(d, name, ljsocketAddress)
+        # Opened after FUSE started, so its scanner won't be started by
+        # startScanners()
+        if d.dispatcher.scanner is not None:
+            d.dispatcher.scanner.start()
+        return name
+
+    def uniqueName(self, name, d, pendingName = None):
+        """
+        name, or name and d's serial number if another device is listed
+        under name. pendingName is d's own pending entry, which doesn't
+        count.
+        """
+        if name in self.deviceByName or (name in self.pendingByName and name != pendingName):
+            # Two devices with the same name; tell them apart by serial
+            name = "%s %s" % (name, d.serialNumber)
+        return name
+
+    def startScanners(self):
+        for d in self.deviceBySerial.values():
+            if d.dispatcher.scanner is not None:
+                d.dispatcher.scanner.start()
+
     def names(self):
         #return [str(d.name) for d in self.devices.values()]
         return self.deviceByName.keys()
 
     def renameDevice(self, old, new):
+        if old in self.pendingByName:
+            dev = self.pendingByName.pop(old)
+            # Applied to the device when it's opened
+            dev["renamed"] = True
+            self.pendingByName[new] = dev
+            return
         dev = self.deviceByName[old]
         dev.name = new
         del(self.deviceByName[old])
@@ -648,42 +3053,138 @@ class LJFuse(Operations):
 
     def __init__(self, pathController):
         self.pathController = pathController
+        # Handles opened with direct_io. A read at offset 0 through one of
+        # these takes a new sample, so a program can keep one descriptor
+        # open and poll with pread(fd, buf, size, 0).
+        self.liveHandles = set()
+        # Open file handles. Maps fh to the contents read on the first
+        # read() through that handle, or None before then.
+        self.handles = dict()
+        # Held writes (see WriteCombiner) made through each handle
+        self.heldWrites = dict()
+        # Data written through each handle to a collectsWrites file, not
+        # yet run
+        self.collected = dict()
+        self.handleLock = threading.Lock()
+        self.lastFh = 9
         if DEBUG: print "LJFuse init"
 
+    def newHandle(self):
+        self.handleLock.acquire()
+        try:
+            self.lastFh += 1
+            self.handles[self.lastFh] = None
+            return self.lastFh
+        finally:
+            self.handleLock.release()
+
+    def init(self, path):
+        # Called once FUSE has daemonized, so threads started here survive
+        self.pathController.dm.startScanners()
+        self.pathController.startRescans()
+
     def getattr(self, path, fh=None):
         try:
-            pathObj = self.pathController.pathDict[path]
+            pathObj = self.pathController.lookup(path)
         except KeyError:
             if DEBUG: print "LJFuse getattr no pathObj for path = ", path
             raise OSError(ENOENT, '')
         
-        if DEBUG: print "LJFuse getattr pathObj = ", pathObj
-        if pathObj.fileType == "DIR":
-            st = dict(st_mode=(S_IFDIR | 0755), st_nlink=2)
-        elif pathObj.fileType == "FILE":
-            if hasattr(pathObj, "mode"):
-                mode = pathObj.mode
-            else:
-                mode = 0444
-            st = dict(st_mode=(S_IFREG | mode), st_size=pathObj.length)
-        else:
-            if DEBUG: print "LJFuse getattr unknown fileType", pathObj.fileType
-        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = time()
-        st['st_uid'], st['st_gid'], pid = fuse_get_context()
-        return st
+        return pathObj.stat()
         
 
     def readdir(self, path, fh):
         try:
-            pathObj = self.pathController.pathDict[path]
+            pathObj = self.pathController.lookup(path, listing = True)
         except KeyError:
             if DEBUG: print "LJFuse readdir no pathObj for path = ", path
             raise OSError(ENOENT, '')
         
-        directoryContents = ['.', '..']
-        
-        directoryContents += self.pathController.childrenNames(pathObj)
-        return directoryContents
+        return self.pathController.childEntries(pathObj)
+
+    def open(self, path, fi):
+        try:
+            pathObj = self.pathController.lookup(path)
+        except KeyError:
+            if DEBUG: print "LJFuse open no pathObj for path = ", path
+            raise OSError(ENOENT, '')
+
+        if pathObj.fileType == "STREAM" or pathObj.live:
+            # Contents (and for some, length) change from read to read, and
+            # the kernel may have cached attributes for attr_timeout
+            # seconds. Send every read to us. Stream files have st_size 0,
+            # so without this the kernel would never ask us for data.
+            fi.direct_io = 1
+        elif pathObj.static:
+            # Never changes, so keep cached pages from one open to the next
+            fi.keep_cache = 1
+        fi.fh = self.newHandle()
+        if fi.direct_io:
+            self.handleLock.acquire()
+            self.liveHandles.add(fi.fh)
+            self.handleLock.release()
+        return 0
+
+    def release(self, path, fi):
+        self.handleLock.acquire()
+        self.handles.pop(fi.fh, None)
+        self.liveHandles.discard(fi.fh)
+        self.heldWrites.pop(fi.fh, None)
+        self.collected.pop(fi.fh, None)
+        self.handleLock.release()
+        return 0
+
+    def runCollected(self, pathObj, fh):
+        """Runs what was written through fh; reads through fh return the reply"""
+        self.handleLock.acquire()
+        data = self.collected.pop(fh, None)
+        self.handleLock.release()
+        if data is None:
+            return
+        result = pathObj.run(data)
+        self.handleLock.acquire()
+        if fh in self.handles:
+            self.handles[fh] = result
+        self.handleLock.release()
+
+    def checkHeldWrites(self, fh, wait):
+        """
+        Raises EIO if a held write made through fh failed. With wait, waits
+        for them all to be sent first; otherwise looks only at those sent.
+        """
+        self.handleLock.acquire()
+        writes = self.heldWrites.get(fh, [])
+        if wait:
+            self.heldWrites.pop(fh, None)
+        else:
+            self.heldWrites[fh] = [write for write in writes if not write.done.isSet()]
+            writes = [write for write in writes if write.done.isSet()]
+        self.handleLock.release()
+        for write in writes:
+            write.done.wait()
+            if write.error is not None:
+                raise OSError(EIO, str(write.error))
+
+    def flush(self, path, fi):
+        # Called on every close, so don't force held writes out here, or
+        # writes from a script's successive echos could never be combined
+        self.checkHeldWrites(fi.fh, False)
+        if fi.fh in self.collected:
+            self.runCollected(self.pathController.lookup(path), fi.fh)
+        return 0
+
+    def fsync(self, path, datasync, fi):
+        try:
+            pathObj = self.pathController.lookup(path)
+        except KeyError:
+            raise OSError(ENOENT, '')
+        device = getattr(pathObj, "device", None)
+        if device is not None and device.dispatcher.combiner is not None:
+            device.dispatcher.combiner.flush()
+        self.checkHeldWrites(fi.fh, True)
+        if pathObj.collectsWrites:
+            self.runCollected(pathObj, fi.fh)
+        return 0
 
     def rename(self, old, new):
         if DEBUG: print "LJFuse rename old = ", old
@@ -705,119 +3206,334 @@ class LJFuse(Operations):
         else:
             raise OSError(EACCES, "Rename not allowed")
 
-    def read(self, path, size, offset, fh):
+    def read(self, path, size, offset, fi):
         try:
-            pathObj = self.pathController.pathDict[path]
+            pathObj = self.pathController.lookup(path)
         except KeyError:
             if DEBUG: print "LJFuse read no pathObj for path = ", path
             raise OSError(ENOENT, '')
 
         if DEBUG: print "LJFuse read pathObj = ", pathObj
 
+        if pathObj.fileType == "STREAM":
+            return pathObj.read(size)
 
-        return pathObj.read()
+        fh = fi.fh
+        if pathObj.collectsWrites:
+            self.runCollected(pathObj, fh)
+            # Hand out the reply from the start whatever the offset, since
+            # writing the requests moved the offset past it
+            self.handleLock.acquire()
+            try:
+                reply = self.handles.get(fh) or ""
+                if fh in self.handles:
+                    self.handles[fh] = reply[size:]
+            finally:
+                self.handleLock.release()
+            return reply[:size]
+
+        # Read the device once per open file and slice that snapshot for
+        # every later read, so a reader that takes several read() calls
+        # costs one transaction and sees one consistent value.
+        snapshot = self.handles.get(fh)
+        if snapshot is None or (offset == 0 and fh in self.liveHandles):
+            snapshot = pathObj.read()
+            self.handleLock.acquire()
+            if fh in self.handles:
+                self.handles[fh] = snapshot
+            self.handleLock.release()
+        return snapshot[offset:offset + size]
 
 
     def truncate(self, path, length, fh=None):
         try:
-            pathObj = self.pathController.pathDict[path]
+            pathObj = self.pathController.lookup(path)
         except KeyError:
             if DEBUG: print "LJFuse truncate no pathObj for path = ", path
             raise OSError(ENOENT, '')
 
         if DEBUG: print "LJFuse truncate pathObj = ", pathObj
 
-    def write(self, path, data, offset, fh):
+    def write(self, path, data, offset, fi):
         try:
-            pathObj = self.pathController.pathDict[path]
+            pathObj = self.pathController.lookup(path)
         except KeyError:
             if DEBUG: print "LJFuse write no pathObj for path = ", path
             raise OSError(ENOENT, '')
 
         if DEBUG: print "LJFuse write pathObj = ", pathObj
 
+        if pathObj.collectsWrites:
+            self.handleLock.acquire()
+            self.collected[fi.fh] = self.collected.get(fi.fh, "") + data
+            self.handleLock.release()
+            return len(data)
+
         if hasattr(pathObj, "write"):
-            pathObj.write(data)
+            result = pathObj.write(data)
         else:
             raise OSError(EACCES, 'Read only')
+
+        if isinstance(result, IORequest):
+            # Held for combining; report failure on flush or fsync
+            self.handleLock.acquire()
+            self.heldWrites.setdefault(fi.fh, []).append(result)
+            self.handleLock.release()
+
+        # Reads through this handle after a write should see the new value
+        self.handleLock.acquire()
+        if fi.fh in self.handles:
+            self.handles[fi.fh] = None
+        self.handleLock.release()
         return len(data)
 
     def create(self, path, mode, fi=None):
         """
-        Create a file in the modbus/ directory
+        Create a file in the modbus/ directory. Every register in the
+        device's map already has one, so this is for other addresses.
         """
-        pathCopy = path
-        parentPathObj, addr = path.rsplit('/', 1)
-        mode = 0664
-        thisDeviceStr = path.split('/')[1]
-        thisDevice = self.pathController.dm.deviceByName[thisDeviceStr]
-
-        # Find a valid Modbus path object
-        while path:
-            try:
-                parentPathObj = self.pathController.pathDict[path]
-                if type(parentPathObj) == ModbusOpPath:
-                    # Found it
-                    break
-            except KeyError:
-                if DEBUG: print "LJFuse write no pathObj for path = ", path
-            # Chop off the end of the path and try again
-            path, end = path.rsplit('/', 1)
-
-        if type(parentPathObj) != ModbusOpPath:
-            raise OSError(EROFS, '')
-
-        if DEBUG: print "LJFuse create path = ", pathCopy
-        if DEBUG: print "LJFuse create parentPathObj = ", parentPathObj
-        if DEBUG: print "LJFuse create mode = ", mode
-        if DEBUG: print "LJFuse create fi = ", fi
-
-        modbusAddrPath = ModbusAddrPath(parentPathObj, addr, thisDevice, int(addr), mode)
-        self.pathController.pathDict[pathCopy] = modbusAddrPath
-
-        # Need a file handle. Create one if we need to
         try:
-            self.thisFi += 1
-        except AttributeError:
-            self.thisFi = 10
-
-        return self.thisFi
+            self.pathController.lookup(path)
+        except KeyError:
+            if DEBUG: print "LJFuse create no pathObj for path = ", path
+            parent, name = path.rsplit('/', 1)
+            parentPathObj = self.pathController.pathDict.get(parent)
+            if not isinstance(parentPathObj, ModbusOpPath):
+                raise OSError(EROFS, '')
+            try:
+                parentPathObj.createRegister(name)
+            except ValueError:
+                raise OSError(EINVAL, 'Not a Modbus address')
+        return self.open(path, fi)
 
 
     # Disable unused operations:
     #access = None  # Need this one for rename
-    flush = None
     getxattr = None
     listxattr = None
-    open = None
     opendir = None
-    release = None
     releasedir = None
     statfs = None
 
+def setCacheTTL(cacheClass, seconds):
+    if cacheClass not in CACHE_TTLS:
+        raise ValueError("Unknown cache class %s. Choose from %s." % (cacheClass, ", ".join(sorted(CACHE_TTLS))))
+    CACHE_TTLS[cacheClass] = float(seconds)
+
+def setHistoryDepth(value):
+    depth = int(value)
+    if depth < 1:
+        raise ValueError("History depth must be at least 1")
+    HISTORY_SETTINGS["depth"] = depth
+
+def setKernelCacheSetting(name, value):
+    if name not in KERNEL_CACHE_SETTINGS:
+        raise ValueError("Unknown mount setting %s. Choose from %s." % (name, ", ".join(sorted(KERNEL_CACHE_SETTINGS))))
+    KERNEL_CACHE_SETTINGS[name] = float(value)
+
+def setCalibrationSetting(name, value):
+    if name == "path":
+        CALIBRATION_SETTINGS["path"] = os.path.expanduser(value)
+    elif name == "refresh":
+        CALIBRATION_SETTINGS["refresh"] = value
+    else:
+        raise ValueError("Unknown calibration setting %s. Choose from %s." % (name, ", ".join(sorted(CALIBRATION_SETTINGS))))
+
+def setDeviceSetting(name, value):
+    if name == "lazy":
+        DEVICE_SETTINGS["lazy"] = value
+    elif name == "rescan":
+        DEVICE_SETTINGS["rescan"] = float(value)
+    else:
+        raise ValueError("Unknown device setting %s. Choose from %s." % (name, ", ".join(sorted(DEVICE_SETTINGS))))
+
+def setLJSocketSetting(name, value):
+    if name != "connections":
+        raise ValueError("Unknown LJSocket setting %s. Choose from %s." % (name, ", ".join(sorted(LJSOCKET_SETTINGS))))
+    connections = int(value)
+    if connections < 1:
+        raise ValueError("Need at least 1 LJSocket connection per device")
+    LJSOCKET_SETTINGS["connections"] = connections
+
+def setBatchWindow(value):
+    window = float(value)
+    if window < 0:
+        raise ValueError("Batch window can't be negative")
+    BATCH_SETTINGS["window"] = window
+
+def setWriteWindow(value):
+    window = float(value)
+    if window < 0:
+        raise ValueError("Write window can't be negative")
+    WRITE_SETTINGS["window"] = window
+
+def setScanSetting(name, value):
+    if name == "rate":
+        SCAN_SETTINGS["rate"] = float(value)
+    elif name == "serials":
+        SCAN_SETTINGS["serials"] = [serial.strip() for serial in value.split(',') if serial.strip()]
+    else:
+        raise ValueError("Unknown scan setting %s. Choose from %s." % (name, ", ".join(sorted(SCAN_SETTINGS))))
+
+def readConfigFile(filename):
+    """
+    Reads LJFuse settings from an INI-style file, for example
+
+        [cache]
+        AIN = 0.05
+        DIO = 0
+        temperature = 1
+
+        [scan]
+        rate = 100
+        serials = 320012345, 360012345
+
+        [history]
+        depth = 1000
+
+        [mount]
+        attr_timeout = 10
+        entry_timeout = 10
+
+        [calibration]
+        path = ~/.ljfuse-calibration
+        refresh = no
+
+        [devices]
+        lazy = no
+        rescan = 5
+
+        [ljsocket]
+        connections = 4
+
+        [write]
+        window = 0.01
+    """
+    config = SafeConfigParser()
+    config.optionxform = str # Keep the case of class names
+    if not config.read(filename):
+        raise IOError("Can't read config file %s" % filename)
+    if config.has_section("cache"):
+        for cacheClass, seconds in config.items("cache"):
+            setCacheTTL(cacheClass, seconds)
+    if config.has_section("scan"):
+        for name, value in config.items("scan"):
+            setScanSetting(name, value)
+    if config.has_option("history", "depth"):
+        setHistoryDepth(config.get("history", "depth"))
+    if config.has_section("mount"):
+        for name, value in config.items("mount"):
+            setKernelCacheSetting(name, value)
+    if config.has_option("calibration", "path"):
+        setCalibrationSetting("path", config.get("calibration", "path"))
+    if config.has_option("calibration", "refresh"):
+        setCalibrationSetting("refresh", config.getboolean("calibration", "refresh"))
+    if config.has_option("devices", "lazy"):
+        setDeviceSetting("lazy", config.getboolean("devices", "lazy"))
+    if config.has_option("devices", "rescan"):
+        setDeviceSetting("rescan", config.get("devices", "rescan"))
+    if config.has_option("batch", "window"):
+        setBatchWindow(config.get("batch", "window"))
+    if config.has_option("write", "window"):
+        setWriteWindow(config.get("write", "window"))
+    if config.has_section("ljsocket"):
+        for name, value in config.items("ljsocket"):
+            setLJSocketSetting(name, value)
+
+def parseArgs(argv):
+    parser = OptionParser(usage = "%prog [options] [mountpoint]")
+    parser.add_option("-c", "--config", metavar = "FILE",
+        help = "read settings from FILE")
+    parser.add_option("--cache-ttl", metavar = "CLASS=SECONDS", action = "append",
+        default = [],
+        help = "cache reads of register class CLASS (%s) for SECONDS. May be repeated." % ", ".join(sorted(CACHE_TTLS)))
+    parser.add_option("--attr-timeout", metavar = "SECONDS",
+        help = "let the kernel cache file attributes for SECONDS (default %g)" % KERNEL_CACHE_SETTINGS["attr_timeout"])
+    parser.add_option("--entry-timeout", metavar = "SECONDS",
+        help = "let the kernel cache name lookups for SECONDS (default %g)" % KERNEL_CACHE_SETTINGS["entry_timeout"])
+    parser.add_option("--scan-rate", metavar = "HZ",
+        help = "scan every connection in the background HZ times a second and serve reads from the latest scan")
+    parser.add_option("--history-depth", metavar = "N",
+        help = "keep the last N samples of each connection in history/ (default %d)" % HISTORY_SETTINGS["depth"])
+    parser.add_option("--scan-serial", metavar = "SERIAL", action = "append",
+        default = [],
+        help = "only scan the device with this serial number. May be repeated.")
+    parser.add_option("--calibration-cache", metavar = "FILE",
+        help = "keep device calibration constants in FILE, or nowhere if empty (default %s)" % CALIBRATION_SETTINGS["path"])
+    parser.add_option("--refresh-calibration", action = "store_true", default = False,
+        help = "read calibration constants from every device and update the calibration cache")
+    parser.add_option("--lazy", action = "store_true", default = False,
+        help = "mount right after listing devices, and open each device when its directory is first used")
+    parser.add_option("--rescan", metavar = "SECONDS",
+        help = "look for connected and disconnected devices every SECONDS")
+    parser.add_option("--batch-window", metavar = "SECONDS",
+        help = "wait up to SECONDS for more reads of a device and fetch adjacent addresses together")
+    parser.add_option("--write-window", metavar = "SECONDS",
+        help = "hold writes to DACs and digital IO for up to SECONDS and send them together; only fsync waits for them and reports their errors")
+    parser.add_option("--ljsocket-connections", metavar = "N",
+        help = "open N LJSocket connections per device and read over them in parallel (default %d)" % LJSOCKET_SETTINGS["connections"])
+    options, args = parser.parse_args(argv)
+    if len(args) > 1:
+        parser.error("too many arguments")
+
+    try:
+        if options.config:
+            readConfigFile(options.config)
+        for setting in options.cache_ttl:
+            cacheClass, seconds = setting.split('=', 1)
+            setCacheTTL(cacheClass, seconds)
+        if options.attr_timeout is not None:
+            setKernelCacheSetting("attr_timeout", options.attr_timeout)
+        if options.entry_timeout is not None:
+            setKernelCacheSetting("entry_timeout", options.entry_timeout)
+        if options.scan_rate is not None:
+            setScanSetting("rate", options.scan_rate)
+        if options.history_depth is not None:
+            setHistoryDepth(options.history_depth)
+        if options.scan_serial:
+            setScanSetting("serials", ','.join(options.scan_serial))
+        if options.calibration_cache is not None:
+            setCalibrationSetting("path", options.calibration_cache)
+        if options.refresh_calibration:
+            setCalibrationSetting("refresh", True)
+        if options.lazy:
+            setDeviceSetting("lazy", True)
+        if options.rescan is not None:
+            setDeviceSetting("rescan", options.rescan)
+        if options.batch_window is not None:
+            setBatchWindow(options.batch_window)
+        if options.write_window is not None:
+            setWriteWindow(options.write_window)
+        if options.ljsocket_connections is not None:
+            setLJSocketSetting("connections", options.ljsocket_connections)
+    except (ValueError, IOError), e:
+        parser.error(str(e))
+    return options, args
+
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
+    options, args = parseArgs(sys.argv[1:])
+    if len(args) == 0:
         mountPoint = DEFAULT_MOUNT_POINT
         if not os.path.isdir(mountPoint):
             print "Making directory", mountPoint, "for LJFuse"
             os.mkdir(mountPoint)
-    elif len(sys.argv) == 2:
-        mountPoint = sys.argv[1]
+    else:
+        mountPoint = args[0]
         if not os.path.isdir(mountPoint):
             print "%s: No such directory. Create it first." % mountPoint
             sys.exit(1)
-    else:
-        print 'usage: %s [mountpoint]' % sys.argv[0]
-        sys.exit(1)
     dm = DeviceManager()
     pathController = PathController(dm)
-    kwargs = dict()
+    # As strings, since FUSE passes any option equal to True (such as
+    # 1.0) as a bare flag
+    kwargs = dict((name, '%g' % value) for name, value in KERNEL_CACHE_SETTINGS.items())
     if DEBUG: kwargs['foreground'] = True
     print "Mounting LJFuse at %s." % mountPoint
     if sys.platform == "darwin":
         unmountStr = "When done, eject it from the Finder or run `umount %s' (without quotes)." % "LJFuse"
         kwargs['volname'] = "LJFuse"
-        kwargs['nolocalcaches'] = True
+        if not any(KERNEL_CACHE_SETTINGS.values()):
+            kwargs['nolocalcaches'] = True
         if os.path.isfile("labjack-icon.icns"):
             kwargs['volicon'] = "labjack-icon.icns"
         if dm.usbOverride:
@@ -828,4 +3544,5 @@ if __name__ == "__main__":
     else:
         unmountStr = "Unmount it with `fusermount -u %s' (without quotes)." % mountPoint
     print unmountStr
-    fuse = FUSE(LJFuse(pathController), mountPoint, **kwargs)
+    # raw_fi lets open() set direct_io and keep_cache per file
+    fuse = FUSE(LJFuse(pathController), mountPoint, raw_fi=True, **kwargs)
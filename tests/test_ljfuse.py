@@ -0,0 +1,93 @@
+"""
+Tests for ljfuse.py that need no hardware. The devices are stand-ins
+with the same method signatures as LabJackPython's, so LabJackPython and
+fusepy must still be importable.
+
+Run from the top of the tree with `python -m unittest discover tests'.
+"""
+
+import os, sys, struct, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ljfuse
+
+
+class ModbusDevice(object):
+    """Records Modbus writes the way LabJackPython's Device takes them"""
+    def __init__(self, devType):
+        self.devType = devType
+        self.writes = []
+
+    def writeRegister(self, addr, value, unitId = None):
+        self.writes.append((addr, value))
+
+
+class TransactTest(unittest.TestCase):
+    def setUp(self):
+        self.device = ModbusDevice(6)
+        self.dispatcher = ljfuse.DeviceDispatcher(self.device)
+
+    def tearDown(self):
+        self.dispatcher.close()
+
+    def words(self, format, *values):
+        packed = struct.pack('>' + format, *values)
+        return list(struct.unpack('>%dH' % (len(packed) / 2), packed))
+
+    def testAdjacentWritesArePackedIntoWords(self):
+        self.dispatcher.transact([('write', 7000, 5), ('write', 7002, 6),
+                                  ('write', 5000, 2.5), ('write', 5002, 1),
+                                  ('write', 6000, 1), ('write', 6001, 0)])
+        self.assertEqual(self.device.writes,
+                         [(7000, self.words('II', 5, 6)),
+                          (5000, self.words('ff', 2.5, 1.0)),
+                          (6000, [1, 0])])
+
+    def testWritesKeepTheirOrder(self):
+        self.dispatcher.transact([('write', 6102, 0), ('write', 6002, 1),
+                                  ('write', 6002, 0), ('write', 6002, 1)])
+        self.assertEqual(self.device.writes,
+                         [(6102, 0), (6002, 1), (6002, 0), (6002, 1)])
+
+
+class FeedbackDevice(object):
+    """Records feedback calls the way LabJackPython's UE9 takes them"""
+    devType = 9
+
+    def __init__(self):
+        self.calls = []
+        self.dispatcher = ljfuse.DeviceDispatcher(self)
+
+    def feedback(self, FIOMask = 0, FIODir = 0, FIOState = 0,
+                 EIOMask = 0, EIODir = 0, EIOState = 0,
+                 CIOMask = 0, CIODirection = 0, CIOState = 0,
+                 MIOMask = 0, MIODirection = 0, MIOState = 0):
+        self.calls.append(dict(CIOMask = CIOMask, CIODirection = CIODirection,
+                               CIOState = CIOState))
+        return dict(FIODir = 0, FIOState = 0, EIODir = 0, EIOState = 0,
+                    CIODir = 0x3, CIOState = 0x1, MIODir = 0, MIOState = 0)
+
+
+class UE9PortTest(unittest.TestCase):
+    def setUp(self):
+        self.device = FeedbackDevice()
+
+    def tearDown(self):
+        self.device.dispatcher.close()
+
+    def testCIOStateWriteKeepsDirections(self):
+        path = ljfuse.PortPath(None, "CIO", self.device, "CIO", False, {})
+        path.write("0x2")
+        self.assertEqual(self.device.calls[-1],
+                         dict(CIOMask = 0xf, CIODirection = 0x3, CIOState = 0x2))
+
+    def testCIODirectionWriteKeepsStates(self):
+        path = ljfuse.PortPath(None, "CIO-dir", self.device, "CIO", True, {})
+        path.write("0xc")
+        self.assertEqual(self.device.calls[-1],
+                         dict(CIOMask = 0xf, CIODirection = 0xc, CIOState = 0x1))
+
+
+if __name__ == '__main__':
+    unittest.main()